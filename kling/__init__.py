@@ -1 +1,22 @@
-from .kling import VideoGen, ImageGen, BaseGen, call_for_daily_check, TaskStatus
+from .kling import (
+    VideoGen,
+    ImageGen,
+    BaseGen,
+    call_for_daily_check,
+    TaskStatus,
+    WorkResult,
+    PointLedger,
+    SessionCache,
+    CancelToken,
+    TaskCancelled,
+    TaskTimeout,
+    S3Sink,
+    TaskHandle,
+    Priority,
+    Scheduler,
+    Tracer,
+    trace,
+    preprocess_image,
+    expand_grid,
+    ProgressTracker,
+)
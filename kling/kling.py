@@ -1,21 +1,69 @@
 import argparse
+import functools
+import hashlib
+import inspect
+import json
+import logging
 import os
+import queue
+import tempfile
 import time
 import contextlib
-from typing import Optional
-from enum import Enum
+import io
+import itertools
+from collections import deque
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from dataclasses import asdict, dataclass, replace
+from typing import Iterator, Optional
+from enum import Enum, IntEnum
 from http.cookies import SimpleCookie
 
 from fake_useragent import UserAgent
 import requests
-from requests.utils import cookiejar_from_dict
+from requests.utils import cookiejar_from_dict, dict_from_cookiejar
+from urllib.parse import parse_qs, urlparse
 from rich import print
+from rich.live import Live
+from rich.table import Table
 import threading
 
+try:
+    import fcntl
+except ImportError:  # windows, no cross process lock
+    fcntl = None
+
+logger = logging.getLogger("kling")
+
 browser_version = "edge101"
 ua = UserAgent(browsers=["edge"])
 base_url = "https://klingai.kuaishou.com/"
 base_url_not_cn = "https://klingai.com/"
+EMPTY_CAMERA = {
+    "type": "empty",
+    "horizontal": 0,
+    "vertical": 0,
+    "zoom": 0,
+    "tilt": 0,
+    "pan": 0,
+    "roll": 0,
+}
+# seconds between two looks at a cancel token while blocked on something else
+CANCEL_CHECK_INTERVAL = 0.1
+# file name for upload tokens issued before the file is known
+PREFETCH_FILE_NAME = "image.jpg"
+# rough points per task unit (a 5s video, 4 images) until the ledger has seen real costs
+ESTIMATED_POINT_COSTS = {
+    "m2v_txt2video": 10,
+    "m2v_img2video": 10,
+    "m2v_txt2video_hq": 35,
+    "m2v_img2video_hq": 35,
+    "m2v_extend_video": 10,
+    "mmu_txt2img_aiweb": 1,
+    "mmu_img2img_aiweb": 1,
+}
 
 
 def call_for_daily_check(session: requests.Session, is_cn: bool) -> bool:
@@ -32,20 +80,781 @@ def call_for_daily_check(session: requests.Session, is_cn: bool) -> bool:
     )
 
 
+class Tracer:
+    """
+    timed spans of http calls, sleeps and phases in chrome trace-event format,
+    open the written file in chrome://tracing or https://ui.perfetto.dev
+    """
+
+    def __init__(self) -> None:
+        self.events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        start = time.time()
+        try:
+            # callers may add args, like the task id, once they know it
+            yield args
+        finally:
+            end = time.time()
+            thread = threading.current_thread()
+            with self._lock:
+                self._threads[thread.ident] = thread.name
+                self.events.append(
+                    {
+                        "name": name,
+                        "cat": category,
+                        "ph": "X",
+                        "ts": start * 1e6,
+                        "dur": (end - start) * 1e6,
+                        "pid": os.getpid(),
+                        "tid": thread.ident,
+                        "args": args,
+                    }
+                )
+
+    def write(self, path: str) -> None:
+        with self._lock:
+            thread_names = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self._threads.items()
+            ]
+            events = thread_names + self.events
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# the tracer of the running `trace` block, None when tracing is off
+_tracer: Optional[Tracer] = None
+
+
+@contextlib.contextmanager
+def trace(path: Optional[str] = None):
+    """
+    record everything the generators do inside the block, written to path at the end
+    """
+    global _tracer
+    previous, _tracer = _tracer, Tracer()
+    tracer = _tracer
+    try:
+        yield tracer
+    finally:
+        _tracer = previous
+        if path:
+            tracer.write(path)
+
+
+@contextlib.contextmanager
+def trace_span(name: str, category: str = "phase", **args):
+    if _tracer is None:
+        yield args
+    else:
+        with _tracer.span(name, category, **args) as span_args:
+            yield span_args
+
+
+def traced(name: str, *arg_names: str, result_as: Optional[str] = None):
+    """
+    record every call of the method as a span, with the named arguments and
+    optionally the return value as span args
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            arguments = signature.bind(*args, **kwargs).arguments
+            span_args = {n: str(arguments[n]) for n in arg_names if n in arguments}
+            with trace_span(name, **span_args) as span:
+                result = func(*args, **kwargs)
+                if result_as:
+                    span[result_as] = str(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
 class TaskStatus(Enum):
     PENDING = 0
     COMPLETED = 1
     FAILED = 3
 
 
+class Priority(IntEnum):
+    # single blocking calls, served before any batch work
+    INTERACTIVE = 0
+    # iterators, sweeps and submit-only handles
+    BATCH = 1
+
+
+class TaskTimeout(Exception):
+    def __init__(self, task_id: str, *more_task_ids: str) -> None:
+        # task_ids has every task that timed out when waiting for several
+        self.task_ids = [task_id, *more_task_ids]
+        super().__init__(
+            f"Request timeout, task {', '.join(self.task_ids)} is still running"
+        )
+        self.task_id = task_id
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """
+    shared between the caller and the running jobs, cancel() stops their polling,
+    sleeps and downloads
+    """
+
+    def __init__(self, parent: Optional["CancelToken"] = None) -> None:
+        self._event = threading.Event()
+        # cancelling the parent cancels this token too
+        self.parent = parent
+
+    def cancel(self) -> None:
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set() or (
+            self.parent is not None and self.parent.cancelled
+        )
+
+    def wait(self, seconds: float) -> bool:
+        if self.parent is None:
+            return self._event.wait(seconds)
+        # the parent does not set our event, look at it now and then
+        deadline = time.time() + seconds
+        while not self.cancelled:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._event.wait(min(remaining, CANCEL_CHECK_INTERVAL))
+        return True
+
+
+@dataclass
+class WorkResult:
+    # index of the job spec this work belongs to
+    job_index: int
+    task_id: str
+    url: str
+    # the sweep coordinates of the job, None outside of a sweep
+    params: Optional[dict] = None
+    # object key once mirrored by an S3Sink
+    key: Optional[str] = None
+
+
+class PointLedger:
+    """
+    local copy of the account balance, decremented on every submit with the cost
+    learned from real balance changes and resynced with the server now and then
+    """
+
+    def __init__(self, costs: Optional[dict] = None, resync_interval: int = 600):
+        # points per task unit, keyed by task type like `m2v_txt2video_hq`,
+        # starts from the estimates
+        self.costs = dict(ESTIMATED_POINT_COSTS, **(costs or {}))
+        self.resync_interval = resync_interval
+        self.balance: Optional[float] = None
+        self.last_sync = 0.0
+        self._synced_balance: Optional[float] = None
+        # (task type, units) charged since the last sync
+        self._unsynced = []
+        # task_id -> (task type, units) until the task is done
+        self._charges = {}
+        self._lock = threading.Lock()
+
+    def needs_sync(self) -> bool:
+        return (
+            self.balance is None or time.time() - self.last_sync > self.resync_interval
+        )
+
+    def sync(self, balance: float) -> None:
+        with self._lock:
+            if self._synced_balance is not None and self._unsynced:
+                task_types = {task_type for task_type, _ in self._unsynced}
+                # only one kind of task since the last sync, so the drop is its cost
+                if len(task_types) == 1:
+                    spent = self._synced_balance - balance
+                    units = sum(units for _, units in self._unsynced)
+                    if spent > 0 and units > 0:
+                        self.costs[task_types.pop()] = round(spent / units, 2)
+            self.balance = balance
+            self._synced_balance = balance
+            self._unsynced = []
+            self.last_sync = time.time()
+
+    def cost(self, task_type: str, units: float = 1) -> float:
+        # units: 2 for a 10s video, 0.5 for 2 images
+        return self.costs.get(task_type, 0) * units
+
+    def check(self, task_type: str, units: float = 1) -> None:
+        cost = self.cost(task_type, units)
+        if self.balance is not None and cost > self.balance:
+            raise Exception(
+                f"Not enough points for {task_type}: need {cost}, have {self.balance}"
+            )
+
+    def reserve(self, task_type: str, units: float = 1) -> None:
+        with self._lock:
+            self.check(task_type, units)
+            if self.balance is not None:
+                self.balance -= self.cost(task_type, units)
+            self._unsynced.append((task_type, units))
+
+    def release(self, task_type: str, units: float = 1) -> None:
+        with self._lock:
+            if self.balance is not None:
+                self.balance += self.cost(task_type, units)
+            with contextlib.suppress(ValueError):
+                self._unsynced.remove((task_type, units))
+
+    def assign(self, task_id: str, task_type: str, units: float = 1) -> None:
+        with self._lock:
+            self._charges[task_id] = (task_type, units)
+
+    def settle(self, task_id: str, refunded: bool = False) -> None:
+        # the server gives the points of a failed task back
+        with self._lock:
+            charge = self._charges.pop(task_id, None)
+        if charge is not None and refunded:
+            self.release(*charge)
+
+
+def expand_grid(grid: dict) -> list:
+    """
+    every combination of the grid values as a job spec, duplicates dropped,
+    a single value is the same as a list with one value
+    """
+    keys = list(grid)
+    values = [v if isinstance(v, (list, tuple)) else [v] for v in grid.values()]
+    jobs, seen = [], set()
+    for combination in itertools.product(*values):
+        job = dict(zip(keys, combination))
+        key = json.dumps(job, sort_keys=True, ensure_ascii=False)
+        if key not in seen:
+            seen.add(key)
+            jobs.append(job)
+    return jobs
+
+
+class _CancellableReader:
+    # the next read after a cancel raises, so a running upload stops
+    def __init__(self, raw, cancel: Optional[CancelToken]) -> None:
+        self.raw = raw
+        self.cancel = cancel
+
+    def read(self, size: int = -1) -> bytes:
+        if self.cancel is not None and self.cancel.cancelled:
+            raise TaskCancelled("Request cancelled")
+        return self.raw.read(size)
+
+
+class S3Sink:
+    """
+    stream works from the kling cdn straight into an S3 compatible bucket with
+    multipart upload, nothing touches the local disk
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        client=None,
+        part_size: int = 8 * 1024 * 1024,
+        max_concurrency: int = 4,
+        **client_kwargs,
+    ) -> None:
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError:
+            raise Exception("S3Sink needs boto3, pip install kling-creator[s3]")
+        self.bucket = bucket
+        self.prefix = prefix
+        # client_kwargs like endpoint_url for minio or other S3 compatible stores
+        self.client = client or boto3.client("s3", **client_kwargs)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=max_concurrency,
+        )
+
+    def object_key(self, result: WorkResult, index: int) -> str:
+        extension = os.path.splitext(urlparse(result.url).path)[1]
+        return f"{self.prefix}{result.task_id}/{index}{extension}"
+
+    def put(
+        self,
+        session: requests.Session,
+        url: str,
+        key: str,
+        callback=None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        with session.get(url, stream=True) as response:
+            if response.status_code != 200:
+                raise Exception(f"Could not download {url}")
+            response.raw.decode_content = True
+            self.client.upload_fileobj(
+                _CancellableReader(response.raw, cancel),
+                self.bucket,
+                key,
+                Config=self.transfer_config,
+                Callback=callback,
+            )
+        return key
+
+
+@dataclass
+class SchedulerTicket:
+    tenant: str
+    priority: Priority
+    # weighted fair queuing tags
+    start: float
+    finish: float
+    seq: int
+    queued_at: float
+
+
+class Scheduler:
+    """
+    share generation capacity between tenants: at most max_concurrent tasks run,
+    a tenant never runs more than its quota, interactive work goes first and
+    the rest is served by weighted fair queuing
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 4,
+        quotas: Optional[dict] = None,
+        weights: Optional[dict] = None,
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        # tenant -> max running tasks, no limit if missing
+        self.quotas = dict(quotas or {})
+        # tenant -> share of the capacity, 1 if missing
+        self.weights = dict(weights or {})
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = {}
+        self._virtual_time = 0.0
+        self._last_finish = {}
+        self._seq = itertools.count()
+        # tenant -> [granted, total wait seconds, max wait seconds]
+        self._waits = {}
+        # task_id -> SchedulerTicket held until the task is done, so any generator
+        # sharing the scheduler can give the slot back
+        self._tasks = {}
+
+    def _next_ticket(self) -> Optional[SchedulerTicket]:
+        if sum(self._running.values()) >= self.max_concurrent:
+            return None
+        candidates = [
+            ticket
+            for ticket in self._waiting
+            if self._running.get(ticket.tenant, 0)
+            < self.quotas.get(ticket.tenant, self.max_concurrent)
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda t: (t.priority, t.finish, t.seq))
+
+    def acquire(
+        self,
+        tenant: str,
+        priority: Priority = Priority.BATCH,
+        cancel: Optional[CancelToken] = None,
+    ) -> SchedulerTicket:
+        with self._cond:
+            start = max(self._virtual_time, self._last_finish.get(tenant, 0.0))
+            finish = start + 1 / self.weights.get(tenant, 1)
+            self._last_finish[tenant] = finish
+            ticket = SchedulerTicket(
+                tenant, priority, start, finish, next(self._seq), time.time()
+            )
+            self._waiting.append(ticket)
+            while self._next_ticket() is not ticket:
+                if cancel is not None and cancel.cancelled:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+                    raise TaskCancelled("Request cancelled")
+                # a cancel does not notify the condition, look at it now and then
+                self._cond.wait(CANCEL_CHECK_INTERVAL if cancel is not None else None)
+            self._waiting.remove(ticket)
+            self._running[tenant] = self._running.get(tenant, 0) + 1
+            self._virtual_time = max(self._virtual_time, ticket.start)
+            waited = time.time() - ticket.queued_at
+            stats = self._waits.setdefault(tenant, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+            # another waiter may fit in the capacity left
+            self._cond.notify_all()
+            return ticket
+
+    def release(self, ticket: SchedulerTicket) -> None:
+        with self._cond:
+            self._running[ticket.tenant] -= 1
+            self._cond.notify_all()
+
+    def hold(self, task_id: str, ticket: SchedulerTicket) -> None:
+        with self._cond:
+            self._tasks[task_id] = ticket
+
+    def release_task(self, task_id: str) -> None:
+        with self._cond:
+            ticket = self._tasks.pop(task_id, None)
+            if ticket is not None:
+                self.release(ticket)
+
+    def stats(self) -> dict:
+        with self._cond:
+            tenants = set(self._running) | {t.tenant for t in self._waiting}
+            now = time.time()
+            result = {}
+            for tenant in sorted(tenants):
+                granted, total_wait, max_wait = self._waits.get(tenant, [0, 0.0, 0.0])
+                queued = [t for t in self._waiting if t.tenant == tenant]
+                result[tenant] = {
+                    "queued": len(queued),
+                    "running": self._running.get(tenant, 0),
+                    "avg_wait": round(total_wait / granted, 2) if granted else 0,
+                    "max_wait": round(
+                        max([max_wait] + [now - t.queued_at for t in queued]), 2
+                    ),
+                }
+            return result
+
+
+@dataclass
+class TaskHandle:
+    """
+    a submitted task, plain data so it can be sent to another thread or process
+    and collected there with wait / poll_once / result
+    """
+
+    task_id: str
+    task_type: str
+    # SessionCache.account of the cookie that submitted it
+    account: str
+    submitted_at: float
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, data: str) -> "TaskHandle":
+        return cls(**json.loads(data))
+
+
+class SessionCache:
+    """
+    per account session state on disk, shared by every process using the same cookie
+    """
+
+    def __init__(self, cookie: str, cache_dir: Optional[str] = None) -> None:
+        cache_dir = (
+            cache_dir
+            or os.environ.get("KLING_CACHE_DIR")
+            or os.path.join(os.path.expanduser("~"), ".cache", "kling")
+        )
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.account = hashlib.sha256(cookie.encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, f"{self.account}.json")
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(f"{self.path}.lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self, state: dict) -> None:
+        # write then rename so readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def update(self, **fields) -> dict:
+        with self.locked():
+            state = self.load()
+            state.update(fields)
+            self.save(state)
+        return state
+
+
+def is_same_day(timestamp: Optional[float]) -> bool:
+    if not timestamp:
+        return False
+    return time.strftime("%Y-%m-%d", time.localtime(timestamp)) == time.strftime(
+        "%Y-%m-%d"
+    )
+
+
+def preprocess_image(
+    image_path: str, max_size: int, output_dir: str, quality: int = 90
+) -> str:
+    """
+    downscale the image so the longer side is at most max_size and re-encode it as
+    jpeg without metadata, same input always gives the same file name and bytes
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise Exception(
+            "Image preprocessing needs Pillow, pip install kling-creator[preprocess]"
+        )
+    with Image.open(image_path) as image:
+        # apply the exif rotation before the exif is dropped
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            # jpeg has no alpha, put the transparent parts on white
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    image_data = buffer.getvalue()
+    output_path = os.path.join(
+        output_dir, f"{hashlib.sha256(image_data).hexdigest()[:32]}.jpg"
+    )
+    if not os.path.exists(output_path):
+        os.makedirs(output_dir, exist_ok=True)
+        # write then rename so other processes never upload half a file
+        fd, tmp_path = tempfile.mkstemp(dir=output_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(image_data)
+        os.replace(tmp_path, output_path)
+    return output_path
+
+
+class ProgressTracker:
+    """
+    in-flight tasks and throughput of one or more generators, shown as a live
+    console table or logged as json lines for headless runs
+    """
+
+    # seconds a finished task stays in the table
+    linger = 30
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        # task_id -> {"type", "phase", "started", "expected", "bytes"}
+        self.tasks = {}
+        # work url -> task_id, so downloads can be counted per task
+        self._works = {}
+        # task type -> seconds of the finished tasks, for the expected time
+        self._durations = {}
+        self.finished = 0
+        self.failed = 0
+        self.polls = 0
+        self.errors = 0
+        self.bytes_downloaded = 0
+        # while a live view or logger is running the poll dots are not printed
+        self.active = False
+        self._lock = threading.Lock()
+
+    def expected_seconds(self, task_type: str, default: float) -> float:
+        durations = self._durations.get(task_type)
+        return sum(durations) / len(durations) if durations else default
+
+    def start(self, task_id: str, task_type: str, expected: float) -> None:
+        with self._lock:
+            self.tasks[task_id] = {
+                "type": task_type,
+                "phase": "generating",
+                "started": time.time(),
+                "expected": self.expected_seconds(task_type, expected),
+                "bytes": 0,
+            }
+
+    def record_poll(self, task_id: str, status: Optional[TaskStatus] = None) -> None:
+        with self._lock:
+            self.polls += 1
+            if status is None:
+                self.errors += 1
+                return
+            task = self.tasks.get(task_id)
+            if not task or task["phase"] != "generating":
+                return
+            if status == TaskStatus.COMPLETED:
+                task["phase"] = "ready"
+                task["finished_at"] = time.time()
+                self._durations.setdefault(task["type"], []).append(
+                    time.time() - task["started"]
+                )
+                self.finished += 1
+            elif status == TaskStatus.FAILED:
+                self.failed += 1
+                del self.tasks[task_id]
+
+    def finish(self, task_id: str, phase: str) -> None:
+        # a task we stopped waiting for (timeout, cancelled, abandoned), it stays
+        # listed a little while but is no longer in flight
+        with self._lock:
+            task = self.tasks.get(task_id)
+            if task and "finished_at" not in task:
+                task["phase"] = phase
+                task["finished_at"] = time.time()
+
+    def add_work(self, task_id: str, url: str) -> None:
+        with self._lock:
+            self._works[url] = task_id
+
+    def add_bytes(self, url: str, size: int) -> None:
+        with self._lock:
+            self.bytes_downloaded += size
+            task = self.tasks.get(self._works.get(url))
+            if task:
+                task["phase"] = "downloading"
+                task["bytes"] += size
+
+    def _prune(self) -> None:
+        # finished tasks stay listed a little while for their downloads
+        now = time.time()
+        for task_id, task in list(self.tasks.items()):
+            if task.get("finished_at", now) < now - self.linger:
+                del self.tasks[task_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._prune()
+            elapsed = max(time.time() - self.started, 1e-6)
+            return {
+                "in_flight": sum(
+                    task["phase"] in ("generating", "ready", "downloading")
+                    for task in self.tasks.values()
+                ),
+                "finished": self.finished,
+                "failed": self.failed,
+                "jobs_per_min": round(self.finished / elapsed * 60, 2),
+                "polls_per_sec": round(self.polls / elapsed, 2),
+                "error_rate": round(self.errors / self.polls, 3) if self.polls else 0,
+                "bytes_downloaded": self.bytes_downloaded,
+            }
+
+    def render(self) -> Table:
+        stats = self.stats()
+        table = Table(
+            title=f"{stats['jobs_per_min']} jobs/min  "
+            f"{stats['polls_per_sec']} polls/s  "
+            f"{stats['error_rate']:.1%} errors  "
+            f"{stats['finished']} done  {stats['failed']} failed"
+        )
+        for column in ["task", "type", "phase", "elapsed / expected", "downloaded"]:
+            table.add_column(column)
+        now = time.time()
+        with self._lock:
+            self._prune()
+            for task_id, task in self.tasks.items():
+                table.add_row(
+                    str(task_id),
+                    task["type"],
+                    task["phase"],
+                    f"{now - task['started']:.0f}s / {task['expected']:.0f}s",
+                    f"{task['bytes'] / 1024 / 1024:.1f} MB",
+                )
+        return table
+
+    @contextlib.contextmanager
+    def live(self, refresh_per_second: float = 2):
+        self.active = True
+        try:
+            with Live(
+                get_renderable=self.render, refresh_per_second=refresh_per_second
+            ):
+                yield self
+        finally:
+            self.active = False
+
+    @contextlib.contextmanager
+    def log_every(self, interval: float = 30):
+        stop = threading.Event()
+
+        def log_stats() -> None:
+            while not stop.wait(interval):
+                logger.info(json.dumps(self.stats()))
+
+        thread = threading.Thread(target=log_stats, daemon=True)
+        self.active = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+            self.active = False
+            logger.info(json.dumps(self.stats()))
+
+
 class BaseGen:
-    def __init__(self, cookie: str) -> None:
+    # seconds between two status polls, spider rule
+    poll_interval = 2
+    # seconds to wait after a task completes before its works can be downloaded
+    work_ready_delay = 2
+    # seconds a task is expected to take until real ones have been seen
+    expected_seconds = 60
+    # status requests in a row that may fail before an iterator gives up on a task
+    max_poll_errors = 5
+    # bytes per read when downloading works
+    chunk_size = 1024 * 1024
+    # a shared Scheduler, None submits right away
+    scheduler: Optional["Scheduler"] = None
+    tenant = "default"
+    # seconds a prefetched upload token is trusted
+    upload_token_ttl = 600
+    # downscale reference images to this longer side before upload, None uploads as is
+    image_max_size: Optional[int] = None
+
+    def __init__(self, cookie: str, cache_dir: Optional[str] = None) -> None:
         self.session: requests.Session = requests.Session()
         self.cookie = cookie
-        self.session.cookies, is_cn = self.parse_cookie_string(self.cookie)
+        self.session_cache = SessionCache(cookie, cache_dir)
+        state = self.session_cache.load()
+        if state.get("cookies"):
+            # start from the cookies the server refreshed for other workers
+            self.session.cookies = cookiejar_from_dict(state["cookies"])
+            is_cn = state["is_cn"]
+        else:
+            self.session.cookies, is_cn = self.parse_cookie_string(self.cookie)
+        self.is_cn = is_cn
         self.session.headers["user-agent"] = ua.random
+        self.session.request = self._traced_request(self.session.request)
         # check the daily login
-        call_for_daily_check(self.session, is_cn)
+        self.daily_check()
         if is_cn:
             self.base_url = base_url
             image_upload_base_url = "https://upload.kuaishouzt.com/"
@@ -53,6 +862,7 @@ class BaseGen:
             self.base_url = base_url_not_cn
             image_upload_base_url = "https://upload.uvfuns.com/"
 
+        self.image_upload_base_url = image_upload_base_url
         self.apis_dict = {
             "image_upload_gettoken": f"{self.base_url}api/upload/issue/token?filename=",
             "image_upload_resume": f"{image_upload_base_url}api/upload/resume?upload_token=",
@@ -66,6 +876,22 @@ class BaseGen:
         self.point_url = f"{self.base_url}api/account/point"
         # store the video id list maybe for future use or extend
         self.video_id_list = []
+        # tasks we stopped waiting for, still running on the server
+        self.unfinished_tasks = []
+        # (job_index, exception) of iterator jobs that failed to submit or generate
+        self.failed_jobs = []
+        self.ledger = PointLedger()
+        # share one tracker between generators to see them in the same view
+        self.progress = ProgressTracker()
+        # original image path -> preprocessed image path
+        self._prepared_images = {}
+        # sha256 of the uploaded bytes -> kling url
+        self._upload_cache = {}
+        # (token, issued_at) fetched ahead of time by prewarm
+        self._upload_tokens = deque()
+        self.image_cache_dir = os.path.join(
+            os.path.dirname(self.session_cache.path), "images"
+        )
 
     @staticmethod
     def parse_cookie_string(cookie_string):
@@ -83,39 +909,97 @@ class BaseGen:
             )
         return cookiejar, is_cn
 
-    def get_account_point(self) -> float:
-        bonus_req = self.session.get(self.daily_url)
-        bonus_data = bonus_req.json()
-        assert bonus_data.get("status") == 200
+    @staticmethod
+    def _traced_request(request):
+        @functools.wraps(request)
+        def traced_request(method, url, *args, **kwargs):
+            if _tracer is None:
+                return request(method, url, *args, **kwargs)
+            parsed = urlparse(url)
+            task_id = parse_qs(parsed.query).get("taskId", [None])[0]
+            with trace_span(
+                f"{method} {parsed.path}",
+                "http",
+                host=parsed.netloc,
+                endpoint=parsed.path,
+                task_id=task_id,
+            ) as span:
+                response = request(method, url, *args, **kwargs)
+                span["status"] = response.status_code
+            return response
+
+        return traced_request
 
+    def daily_check(self) -> bool:
+        """
+        call the daily reward at most once per account per day, across processes
+        """
+        with self.session_cache.locked():
+            state = self.session_cache.load()
+            if is_same_day(state.get("last_daily_check")):
+                return False
+            call_for_daily_check(self.session, self.is_cn)
+            state["last_daily_check"] = time.time()
+            state.update(self._session_state())
+            self.session_cache.save(state)
+        return True
+
+    def _session_state(self) -> dict:
+        cookies = self.session.cookies
+        return {
+            "cookies": dict_from_cookiejar(cookies) if cookies is not None else {},
+            "is_cn": self.is_cn,
+        }
+
+    def save_session_state(self) -> None:
+        # keep the cookies the server refreshed for the next worker
+        self.session_cache.update(**self._session_state())
+
+    def get_account_point(self, refresh: bool = False) -> float:
+        """
+        return the cached balance, only ask the server when refresh is set
+        or the ledger is out of date
+        """
+        if refresh or self.ledger.needs_sync():
+            self.ledger.sync(self._fetch_account_point())
+        return self.ledger.balance
+
+    def _check_points(self, task_type: str, units: float = 1) -> None:
+        # the first check fetches the balance, later ones use the ledger
+        self.get_account_point()
+        self.ledger.check(task_type, units)
+
+    def _fetch_account_point(self) -> float:
+        self.daily_check()
         point_req = self.session.get(self.point_url)
         point_data = point_req.json()
         assert point_data.get("status") == 200
 
         total_point = point_data["data"]["total"]
+        self.save_session_state()
         return total_point / 100
 
+    @traced("upload", "image_path", result_as="url")
     def image_uploader(self, image_path) -> str:
         """
         from https://github.com/dolacmeo/acfunsdk/blob/ece6f42e2736b316fea35d89ba1d0ccbec6c98f7/acfun/page/utils.py
         great thanks to him
         """
+        if self.image_max_size:
+            if image_path not in self._prepared_images:
+                self._prepared_images[image_path] = preprocess_image(
+                    image_path, self.image_max_size, self.image_cache_dir
+                )
+            image_path = self._prepared_images[image_path]
         with open(image_path, "rb") as f:
             image_data = f.read()
-        # get the image file name
-        file_name = image_path.split("/")[-1]
-        upload_url = self.apis_dict["image_upload_gettoken"] + file_name
-        token_req = self.session.get(upload_url)
-        token_data = token_req.json()
-
-        assert token_data.get("status") == 200
-
-        token = token_data["data"]["token"]
-        resume_url = self.apis_dict["image_upload_resume"] + token
-        resume_req = self.session.get(resume_url)
-        resume_data = resume_req.json()
-
-        assert resume_data.get("result") == 1
+        digest = hashlib.sha256(image_data).hexdigest()
+        if digest in self._upload_cache:
+            return self._upload_cache[digest]
+        token = self._take_upload_token()
+        if token is None:
+            # get the image file name
+            token = self._new_upload_token(image_path.split("/")[-1])
         fragment_req = self.session.post(
             self.apis_dict["image_upload_fragment"],
             data=image_data,
@@ -134,25 +1018,704 @@ class BaseGen:
         result_req = self.session.get(verify_url)
         result_data = result_req.json()
         assert result_data.get("status") == 200
-        return result_data.get("data").get("url")
+        url = result_data.get("data").get("url")
+        self._upload_cache[digest] = url
+        return url
+
+    def _new_upload_token(self, file_name: str) -> str:
+        # issue a token and open its upload, everything before the bytes are sent
+        upload_url = self.apis_dict["image_upload_gettoken"] + file_name
+        token_req = self.session.get(upload_url)
+        token_data = token_req.json()
+
+        assert token_data.get("status") == 200
+
+        token = token_data["data"]["token"]
+        resume_url = self.apis_dict["image_upload_resume"] + token
+        resume_req = self.session.get(resume_url)
+        resume_data = resume_req.json()
 
+        assert resume_data.get("result") == 1
+        return token
+
+    def _take_upload_token(self) -> Optional[str]:
+        while True:
+            try:
+                token, issued_at = self._upload_tokens.popleft()
+            except IndexError:
+                return None
+            if time.time() - issued_at < self.upload_token_ttl:
+                return token
+
+    def prewarm(
+        self,
+        upload_tokens: int = 0,
+        connections: int = 2,
+        hosts: Optional[list] = None,
+        background: bool = True,
+    ) -> Optional[threading.Thread]:
+        """
+        open keep-alive connections to the api, upload and extra hosts (e.g. the cdn)
+        and prefetch upload tokens, so a burst of jobs skips the handshakes
+        """
+
+        def warm_up() -> None:
+            urls = [self.base_url, self.image_upload_base_url] + list(hosts or [])
+            # parallel requests so the pool keeps `connections` sockets per host
+            warm_urls = [url for url in urls for _ in range(connections)]
+            with ThreadPoolExecutor(max_workers=max(len(warm_urls), 1)) as executor:
+                list(executor.map(self._warm_connection, warm_urls))
+                for token in executor.map(
+                    self._new_upload_token, [PREFETCH_FILE_NAME] * upload_tokens
+                ):
+                    self._upload_tokens.append((token, time.time()))
+
+        if not background:
+            warm_up()
+            return None
+        thread = threading.Thread(target=warm_up, daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_connection(self, url: str) -> None:
+        # any answer is fine, only the dns, tcp and tls work is wanted
+        with contextlib.suppress(requests.RequestException):
+            self.session.head(url, timeout=10)
+
+    def prepare_images(
+        self, image_paths: list, max_workers: Optional[int] = None
+    ) -> tuple:
+        """
+        preprocess the images in a process pool, returns (pool, {image_path: Future}),
+        the caller must shut the pool down
+        """
+        pool = ProcessPoolExecutor(max_workers=max_workers)
+        futures = {
+            image_path: pool.submit(
+                preprocess_image, image_path, self.image_max_size, self.image_cache_dir
+            )
+            for image_path in set(image_paths)
+        }
+        return pool, futures
+
+    @traced("poll", "task_id")
     def fetch_metadata(self, task_id: str) -> tuple[dict, TaskStatus]:
         url = f"{self.base_url}api/task/status?taskId={task_id}"
-        response = self.session.get(url)
-        data = response.json().get("data")
-        assert data is not None
+        try:
+            response = self.session.get(url)
+            data = response.json().get("data")
+            assert data is not None
+        except Exception:
+            self.progress.record_poll(task_id)
+            raise
         # this is very interesting it use resolution to check if the image is ready
         if data.get("status") >= 90:
-            return data, TaskStatus.COMPLETED
+            status = TaskStatus.COMPLETED
         elif data.get("status") in [9, 50]:
-            return data, TaskStatus.FAILED
+            status = TaskStatus.FAILED
         else:
-            return data, TaskStatus.PENDING
+            status = TaskStatus.PENDING
+        self.progress.record_poll(task_id, status)
+        if status != TaskStatus.PENDING:
+            self.ledger.settle(task_id, refunded=status == TaskStatus.FAILED)
+            self._release_task(task_id)
+        return data, status
+
+    def _scheduled_submit(
+        self,
+        payload: dict,
+        priority: Priority,
+        cancel: Optional[CancelToken] = None,
+        hold: bool = True,
+    ) -> str:
+        # the scheduler slot is held from submit until the task is done,
+        # or given back right after the submit without hold
+        ticket = None
+        if self.scheduler is not None:
+            ticket = self.scheduler.acquire(self.tenant, priority, cancel)
+        try:
+            # the wait for a slot can be long, never pay for cancelled work
+            if cancel is not None and cancel.cancelled:
+                raise TaskCancelled("Request cancelled")
+            task_id = self._submit_payload(payload)
+        except Exception:
+            if ticket is not None:
+                self.scheduler.release(ticket)
+            raise
+        if ticket is not None:
+            if hold:
+                self.scheduler.hold(task_id, ticket)
+            else:
+                self.scheduler.release(ticket)
+        return task_id
+
+    def _release_task(self, task_id: str) -> None:
+        if self.scheduler is not None:
+            self.scheduler.release_task(task_id)
+
+    @traced("submit", result_as="task_id")
+    def _submit_payload(self, payload: dict) -> str:
+        # the first submit fetches the balance, then it is resynced now and then
+        self.get_account_point()
+        task_type = payload["type"]
+        units = self.cost_units(payload)
+        self.ledger.reserve(task_type, units)
+        try:
+            response = self.session.post(
+                self.submit_url,
+                json=payload,
+            )
+            if not response.ok:
+                print(response.text)
+                raise Exception(f"Error response {str(response)}")
+            response_body = response.json()
+            if response_body.get("data").get("status") == 7:
+                message = response_body.get("data").get("message")
+                raise Exception(f"Request failed message {message}")
+            request_id = (response_body.get("data", {}).get("task") or {}).get("id")
+            if not request_id:
+                raise Exception("Could not get request ID")
+        except Exception:
+            self.ledger.release(task_type, units)
+            raise
+        self.ledger.assign(request_id, task_type, units)
+        self.progress.start(request_id, task_type, self.expected_seconds)
+        return request_id
+
+    @traced("sleep", "seconds")
+    def _sleep(self, seconds: float, cancel: Optional[CancelToken] = None) -> None:
+        # a cancel token wakes the sleep up at once
+        if cancel is None:
+            time.sleep(seconds)
+        elif cancel.wait(seconds):
+            raise TaskCancelled("Request cancelled")
+
+    @traced("wait", "request_id")
+    def wait_for_task(
+        self,
+        request_id: str,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+        kind: str = "images",
+    ) -> list:
+        """
+        poll the task until it is done, raises TaskTimeout with the task id after
+        timeout seconds so the task can be picked up again later
+        """
+        try:
+            return self._poll_task(request_id, timeout, cancel, kind)
+        except TaskCancelled:
+            self.progress.finish(request_id, "cancelled")
+            raise
+        finally:
+            # a task we stop waiting for gives its scheduler slot back
+            self._release_task(request_id)
+
+    def _poll_task(
+        self,
+        request_id: str,
+        timeout: float,
+        cancel: Optional[CancelToken],
+        kind: str,
+    ) -> list:
+        deadline = time.time() + timeout
+        while True:
+            if cancel is not None and cancel.cancelled:
+                raise TaskCancelled("Request cancelled")
+            image_data, status = self.fetch_metadata(request_id)
+            if status == TaskStatus.PENDING:
+                if time.time() >= deadline:
+                    self.unfinished_tasks.append(request_id)
+                    self.progress.finish(request_id, "timeout")
+                    raise TaskTimeout(request_id)
+                if not self.progress.active:
+                    print(".", end="", flush=True)
+                # spider rule, the deadline may have passed since it was checked
+                self._sleep(
+                    max(0, min(self.poll_interval, deadline - time.time())), cancel
+                )
+            elif status == TaskStatus.FAILED:
+                print("Request failed")
+                return []
+            else:
+                result = []
+                works = image_data.get("works", [])
+                if not works:
+                    print(f"No {kind} found.")
+                    return []
+                else:
+                    for work in works:
+                        resource = work.get("resource", {}).get("resource")
+                        if resource:
+                            # sleep for 2s for waiting the video to be ready in kuaishou server
+                            self._sleep(self.work_ready_delay, cancel)
+                            self.progress.add_work(request_id, resource)
+                            result.append(resource)
+                return result
+
+    def _iter_completed(
+        self, task_ids: list, deadlines: list, cancel: Optional[CancelToken] = None
+    ) -> Iterator[WorkResult]:
+        """
+        poll all the tasks together and yield every work as soon as its task is done,
+        the ready delay of one task does not block polling the others
+        """
+        arrivals = queue.Queue()
+        for job_index, (task_id, deadline) in enumerate(zip(task_ids, deadlines)):
+            arrivals.put((job_index, task_id, deadline))
+        return self._poll_tasks(arrivals, len(task_ids), cancel)
+
+    def _poll_tasks(
+        self, arrivals: queue.Queue, total: int, cancel: Optional[CancelToken]
+    ) -> Iterator[WorkResult]:
+        """
+        arrivals gets (job_index, task_id, deadline) as jobs are submitted, or
+        (job_index, exception, None) if a submit failed, failed jobs are recorded
+        in failed_jobs and the others keep going
+        """
+        pending, deadlines, seen = {}, {}, []
+        # job_index -> failed status requests in a row
+        poll_errors = {}
+        arrived = 0
+        # (ready_at, WorkResult) in the order they completed
+        ready = []
+        next_poll = time.time()
+        try:
+            while arrived < total or pending or ready:
+                while True:
+                    try:
+                        job_index, task_id, deadline = arrivals.get_nowait()
+                    except queue.Empty:
+                        break
+                    arrived += 1
+                    if isinstance(task_id, TaskCancelled):
+                        raise task_id
+                    if isinstance(task_id, Exception):
+                        # one failed submit does not stop the other jobs
+                        print(f"Job {job_index} failed: {task_id}")
+                        self.failed_jobs.append((job_index, task_id))
+                        continue
+                    pending[job_index] = task_id
+                    deadlines[job_index] = deadline
+                    seen.append(task_id)
+                now = time.time()
+                while ready and ready[0][0] <= now:
+                    yield ready.pop(0)[1]
+                if pending and now >= next_poll:
+                    for job_index, task_id in list(pending.items()):
+                        try:
+                            data, status = self.fetch_metadata(task_id)
+                        except Exception as e:
+                            # a flaky status request only counts against this task,
+                            # it is asked again next round
+                            poll_errors[job_index] = poll_errors.get(job_index, 0) + 1
+                            if (
+                                poll_errors[job_index] < self.max_poll_errors
+                                and time.time() < deadlines[job_index]
+                            ):
+                                continue
+                            print(f"Request {task_id} status unknown, pick it up later")
+                            print(e)
+                            self.unfinished_tasks.append(task_id)
+                            self.progress.finish(task_id, "abandoned")
+                            self._release_task(task_id)
+                            del pending[job_index]
+                            continue
+                        poll_errors.pop(job_index, None)
+                        if status == TaskStatus.PENDING:
+                            if time.time() >= deadlines[job_index]:
+                                # give up waiting, the task keeps running on the server
+                                print(f"Request {task_id} timeout, pick it up later")
+                                self.unfinished_tasks.append(task_id)
+                                self.progress.finish(task_id, "timeout")
+                                self._release_task(task_id)
+                                del pending[job_index]
+                            continue
+                        del pending[job_index]
+                        if status == TaskStatus.FAILED:
+                            print(f"Request {task_id} failed")
+                            self.failed_jobs.append(
+                                (job_index, Exception(f"Request {task_id} failed"))
+                            )
+                            continue
+                        for work in data.get("works", []):
+                            resource = work.get("resource", {}).get("resource")
+                            if resource:
+                                self.progress.add_work(task_id, resource)
+                                ready.append(
+                                    (
+                                        time.time() + self.work_ready_delay,
+                                        WorkResult(job_index, task_id, resource),
+                                    )
+                                )
+                    next_poll = now + self.poll_interval
+                wake_up = [next_poll] if pending else []
+                if pending:
+                    wake_up.append(min(deadlines[i] for i in pending))
+                if ready:
+                    wake_up.append(ready[0][0])
+                if arrived < total:
+                    # a new submit wakes the loop up, keep it for the next round
+                    seconds = (min(wake_up) - time.time()) if wake_up else None
+                    if cancel is not None:
+                        # a cancel does not, look at it now and then
+                        seconds = min(
+                            CANCEL_CHECK_INTERVAL,
+                            seconds if seconds is not None else CANCEL_CHECK_INTERVAL,
+                        )
+                    with contextlib.suppress(queue.Empty):
+                        arrival = arrivals.get(
+                            timeout=max(0, seconds) if seconds is not None else None
+                        )
+                        arrivals.put(arrival)
+                    if cancel is not None and cancel.cancelled:
+                        raise TaskCancelled("Request cancelled")
+                elif wake_up:
+                    self._sleep(max(0, min(wake_up) - time.time()), cancel)
+        finally:
+            # tasks we stopped polling early keep running on the server
+            self.unfinished_tasks.extend(pending.values())
+            phase = (
+                "cancelled" if cancel is not None and cancel.cancelled else "abandoned"
+            )
+            for task_id in pending.values():
+                self.progress.finish(task_id, phase)
+            for task_id in seen:
+                self._release_task(task_id)
+
+    def _iter_jobs(
+        self,
+        build_payload,
+        jobs: list,
+        max_workers: int = 4,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+        priority: Priority = Priority.BATCH,
+    ) -> Iterator[WorkResult]:
+        """
+        a job may have its own `timeout`, otherwise the shared one is used
+        """
+        image_paths = [job["image_path"] for job in jobs if job.get("image_path")]
+        pool, prepared = None, {}
+        if self.image_max_size and image_paths:
+            # images are prepared in other processes while earlier jobs upload
+            pool, prepared = self.prepare_images(image_paths)
+        arrivals = queue.Queue()
+        # set once polling stops, the user's cancel sets it too
+        stopped = CancelToken(cancel)
+
+        def submit(job_index: int, job: dict) -> None:
+            job = dict(job)
+            job_timeout = job.pop("timeout", timeout)
+            try:
+                # cancelled jobs leave the worker at once
+                if stopped.cancelled:
+                    raise TaskCancelled("Request cancelled")
+                image_path = job.get("image_path")
+                if image_path in prepared:
+                    with trace_span("preprocess", image_path=image_path):
+                        self._prepared_images[image_path] = prepared[
+                            image_path
+                        ].result()
+                task_id = self._scheduled_submit(
+                    build_payload(**job), priority, stopped
+                )
+            except Exception as e:
+                arrivals.put((job_index, e, None))
+            else:
+                arrivals.put((job_index, task_id, time.time() + job_timeout))
+
+        # submit (and upload) concurrently while the submitted tasks are polled
+        print(f"Submitting {len(jobs)} jobs, waiting for results...")
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for job_index, job in enumerate(jobs):
+                executor.submit(submit, job_index, job)
+            yield from self._poll_tasks(arrivals, len(jobs), cancel)
+        finally:
+            stopped.cancel()
+            executor.shutdown()
+            if pool:
+                pool.shutdown()
+            # tasks submitted after the polling stopped, still running on the server
+            while not arrivals.empty():
+                _, task_id, _ = arrivals.get()
+                if isinstance(task_id, str):
+                    self.unfinished_tasks.append(task_id)
+                    self.progress.finish(task_id, "abandoned")
+                    self._release_task(task_id)
+
+    def _submit_handle(self, payload: dict) -> TaskHandle:
+        # nobody may ever collect the handle here, so it waits for a free slot
+        # but does not keep it
+        task_id = self._scheduled_submit(payload, Priority.BATCH, hold=False)
+        return TaskHandle(
+            task_id, payload["type"], self.session_cache.account, time.time()
+        )
+
+    def _check_handle(self, handle: TaskHandle) -> None:
+        if handle.account != self.session_cache.account:
+            raise Exception(f"Task {handle.task_id} was submitted by another account")
+
+    def poll_once(self, handles):
+        """
+        one status request per handle, returns a TaskStatus or a list of them
+        """
+        if isinstance(handles, TaskHandle):
+            return self.poll_once([handles])[0]
+        statuses = []
+        for handle in handles:
+            self._check_handle(handle)
+            statuses.append(self.fetch_metadata(handle.task_id)[1])
+        return statuses
+
+    def result(self, handles):
+        """
+        the urls of finished tasks ([] if it failed) without waiting,
+        raises if a task is still running
+        """
+        if isinstance(handles, TaskHandle):
+            return self.result([handles])[0]
+        results = []
+        for handle in handles:
+            self._check_handle(handle)
+            data, status = self.fetch_metadata(handle.task_id)
+            if status == TaskStatus.PENDING:
+                raise Exception(f"Task {handle.task_id} is still running")
+            results.append(
+                [
+                    work["resource"]["resource"]
+                    for work in data.get("works", [])
+                    if work.get("resource", {}).get("resource")
+                ]
+                if status == TaskStatus.COMPLETED
+                else []
+            )
+        return results
+
+    def wait(
+        self,
+        handles,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ):
+        """
+        block until the tasks are done, a list of handles is polled together and
+        gives a list of url lists in the same order, raises TaskTimeout with the
+        ids of the tasks still running after timeout
+        """
+        if isinstance(handles, TaskHandle):
+            self._check_handle(handles)
+            kind = "video" if handles.task_type.startswith("m2v") else "images"
+            return self.wait_for_task(handles.task_id, timeout, cancel, kind=kind)
+        for handle in handles:
+            self._check_handle(handle)
+        results = [[] for _ in handles]
+        deadline = time.time() + timeout
+        unfinished_before = len(self.unfinished_tasks)
+        task_ids = [handle.task_id for handle in handles]
+        for work in self._iter_completed(task_ids, [deadline] * len(handles), cancel):
+            results[work.job_index].append(work.url)
+        unfinished = set(self.unfinished_tasks[unfinished_before:])
+        timed_out = [task_id for task_id in task_ids if task_id in unfinished]
+        if timed_out:
+            raise TaskTimeout(*timed_out)
+        return results
+
+    def mirror(
+        self,
+        results,
+        sink: S3Sink,
+        max_workers: int = 4,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[WorkResult]:
+        """
+        copy every work of `results` (e.g. from iter_videos) into the sink while
+        the other jobs are still generating, yields the results with their key,
+        stopping early cancels `cancel`, give the same token to the iterator
+        feeding it so its polling stops too
+        """
+        # works of the same task get 0, 1, 2... in their key
+        task_counts = {}
+
+        def put(result: WorkResult, index: int) -> WorkResult:
+            if cancel is not None and cancel.cancelled:
+                raise TaskCancelled("Request cancelled")
+            with trace_span("mirror", task_id=result.task_id, url=result.url):
+                key = sink.put(
+                    self.session,
+                    result.url,
+                    sink.object_key(result, index),
+                    callback=lambda size: self.progress.add_bytes(result.url, size),
+                    cancel=cancel,
+                )
+            return replace(result, key=key)
+
+        # futures of finished uploads, then the number of uploads once results run out
+        completed = queue.Queue()
+        stopped = threading.Event()
+
+        def feed(executor: ThreadPoolExecutor) -> None:
+            # read the results in their own thread, so a slow input does not hold
+            # back the uploads that are already done
+            submitted = 0
+            iterator = iter(results)
+            try:
+                for result in iterator:
+                    if stopped.is_set():
+                        break
+                    index = task_counts.get(result.task_id, 0)
+                    task_counts[result.task_id] = index + 1
+                    future = executor.submit(put, result, index)
+                    future.add_done_callback(completed.put)
+                    submitted += 1
+            except Exception as e:
+                completed.put(e)
+            finally:
+                if stopped.is_set() and hasattr(iterator, "close"):
+                    iterator.close()
+                completed.put(submitted)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            feeder = threading.Thread(target=feed, args=(executor,), daemon=True)
+            feeder.start()
+            yielded, total = 0, None
+            try:
+                while total is None or yielded < total:
+                    item = completed.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    if isinstance(item, int):
+                        total = item
+                        continue
+                    yielded += 1
+                    yield item.result()
+            finally:
+                stopped.set()
+                if total is None and cancel is not None and feeder.is_alive():
+                    # stopped before the results ran out, wake the input up
+                    cancel.cancel()
+                    feeder.join()
+
+    def _download(
+        self, url: str, path: str, cancel: Optional[CancelToken] = None
+    ) -> None:
+        # stream to the file so the progress shows the bytes as they come
+        # and a cancel stops between two chunks
+        with trace_span("download", url=url):
+            response = self.session.get(url, stream=True)
+            try:
+                if response.status_code != 200:
+                    raise Exception(f"Could not download {url}")
+                with open(path, "wb") as output_file:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        if cancel is not None and cancel.cancelled:
+                            raise TaskCancelled("Request cancelled")
+                        output_file.write(chunk)
+                        self.progress.add_bytes(url, len(chunk))
+            except TaskCancelled:
+                # no half written file left behind
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                raise
+            finally:
+                response.close()
+
+    def estimate_cost(self, job: dict) -> float:
+        return 0
+
+    def cost_units(self, payload: dict) -> float:
+        return 1
+
+    @staticmethod
+    def _payload_argument(payload: dict, name: str) -> Optional[str]:
+        for argument in payload.get("arguments", []):
+            if argument.get("name") == name:
+                return argument.get("value")
+        return None
+
+    def _unused_arguments(self, arguments: dict) -> set:
+        # builder arguments that do not make it into the payload of this job
+        return set()
+
+    def _job_key(self, build_payload, job: dict) -> str:
+        # the arguments as the payload sees them, 0.5 and "0.5" are the same
+        bound = inspect.signature(build_payload).bind(**job)
+        bound.apply_defaults()
+        unused = self._unused_arguments(bound.arguments)
+        arguments = {
+            name: value if isinstance(value, dict) else str(value)
+            for name, value in bound.arguments.items()
+            if name not in unused
+        }
+        return json.dumps(arguments, sort_keys=True, ensure_ascii=False)
+
+    def _sweep(self, build_payload, grid: dict, max_workers: int, **kwargs):
+        # a typo would otherwise fail every job in its submit thread
+        parameters = set(inspect.signature(build_payload).parameters) | {"timeout"}
+        unknown = set(grid) - parameters
+        if unknown:
+            raise Exception(
+                f"Unknown sweep parameters {sorted(unknown)}, "
+                f"expected some of {sorted(parameters)}"
+            )
+        jobs, seen = [], set()
+        for job in expand_grid(grid):
+            key = self._job_key(
+                build_payload, {k: v for k, v in job.items() if k != "timeout"}
+            )
+            if key not in seen:
+                seen.add(key)
+                jobs.append(job)
+        # cheapest first so most of the grid comes back early
+        jobs.sort(key=self.estimate_cost)
+        print(f"Sweeping {len(jobs)} combinations")
+        return (
+            replace(result, params=jobs[result.job_index])
+            for result in self._iter_jobs(build_payload, jobs, max_workers, **kwargs)
+        )
 
 
 class VideoGen(BaseGen):
+    poll_interval = 5
+    expected_seconds = 300
+
+    @staticmethod
+    def video_task_type(with_image: bool, is_high_quality: bool) -> str:
+        task_type = "m2v_img2video" if with_image else "m2v_txt2video"
+        return f"{task_type}_hq" if is_high_quality else task_type
+
+    def estimate_cost(self, job: dict) -> float:
+        task_type = self.video_task_type(
+            bool(job.get("image_path") or job.get("image_url")),
+            job.get("is_high_quality", False),
+        )
+        return self.ledger.cost(task_type, int(job.get("duration", 5)) / 5)
+
+    def _unused_arguments(self, arguments: dict) -> set:
+        # image to video takes the aspect ratio of the image
+        if arguments.get("image_path") or arguments.get("image_url"):
+            return {"aspect_ratio"}
+        return set()
+
+    def cost_units(self, payload: dict) -> float:
+        # a 5s video is one unit, extends have no duration
+        return int(self._payload_argument(payload, "duration") or 5) / 5
 
-    def extend_video(self, video_id: int, prompt: str = "") -> str:
+    def extend_video(
+        self,
+        video_id: int,
+        prompt: str = "",
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        payload = self._build_extend_payload(video_id)
+        return self._get_video_with_payload(payload, timeout, cancel)
+
+    def submit_extend(self, video_id: int, prompt: str = "") -> TaskHandle:
+        return self._submit_handle(self._build_extend_payload(video_id))
+
+    def _build_extend_payload(self, video_id: int) -> dict:
         # get the video url and init_prompt
         data, status = self.fetch_metadata(video_id)
         assert status == TaskStatus.COMPLETED
@@ -205,73 +1768,46 @@ class VideoGen(BaseGen):
                 },
             ],
         }
-        return self._get_video_with_payload(payload)
+        return payload
 
-    def _get_video_with_payload(self, payload: dict) -> list:
-        response = self.session.post(
-            self.submit_url,
-            json=payload,
-        )
-        if not response.ok:
-            print(response.text)
-            raise Exception(f"Error response {str(response)}")
-        response_body = response.json()
-        if response_body.get("data").get("status") == 7:
-            message = response_body.get("data").get("message")
-            raise Exception(f"Request failed message {message}")
-        request_id = response_body.get("data", {}).get("task", {}).get("id")
-
-        if not request_id:
-            raise Exception("Could not get request ID")
+    def _get_video_with_payload(
+        self,
+        payload: dict,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ) -> list:
+        request_id = self._scheduled_submit(payload, Priority.INTERACTIVE, cancel)
         # store the video id list
         self.video_id_list.append(request_id)
-        start_wait = time.time()
         print("Waiting for results... will take 2mins to 5mins")
-        while True:
-            if int(time.time() - start_wait) > 1200:
-                raise Exception("Request timeout")
-            image_data, status = self.fetch_metadata(request_id)
-            if status == TaskStatus.PENDING:
-                print(".", end="", flush=True)
-                # spider rule
-                time.sleep(5)
-            elif status == TaskStatus.FAILED:
-                print("Request failed")
-                return []
-            else:
-                result = []
-                works = image_data.get("works", [])
-                if not works:
-                    print("No video found.")
-                    return []
-                else:
-                    for work in works:
-                        resource = work.get("resource", {}).get("resource")
-                        if resource:
-                            # sleep for 2s for waiting the video to be ready in kuaishou server
-                            time.sleep(2)
-                            result.append(resource)
-                return result
+        return self.wait_for_task(request_id, timeout, cancel, kind="video")
 
-    def get_video(
+    def _build_video_payload(
         self,
         prompt: str,
         image_path: Optional[str] = None,
         image_url: Optional[str] = None,
         is_high_quality: bool = False,
-        auto_extend: bool = False,
         model_name: str = "1.0",
-    ) -> list:
-        self.session.headers["user-agent"] = ua.random
+        cfg: float = 0.5,
+        duration: int = 5,
+        aspect_ratio: str = "16:9",
+        camera: Optional[dict] = None,
+    ) -> dict:
+        model_type = self.video_task_type(
+            bool(image_path or image_url), is_high_quality
+        )
+        # camera keys missing from `camera` stay still
+        camera_json = json.dumps(
+            dict(EMPTY_CAMERA, **(camera or {})), separators=(",", ":")
+        )
         if image_path or image_url:
+            # reject before uploading anything if the account can not afford it
+            self._check_points(model_type, int(duration) / 5)
             if image_path:
                 image_payload_url = self.image_uploader(image_path)
             else:
                 image_payload_url = image_url
-            if is_high_quality:
-                model_type = "m2v_img2video_hq"
-            else:
-                model_type = "m2v_img2video"
             payload = {
                 "arguments": [
                     {"name": "prompt", "value": prompt},
@@ -281,11 +1817,11 @@ class VideoGen(BaseGen):
                     },
                     {
                         "name": "cfg",
-                        "value": "0.5",
+                        "value": str(cfg),
                     },
                     {
                         "name": "duration",
-                        "value": "5",
+                        "value": str(duration),
                     },
                     {
                         "name": "kling_version",
@@ -297,7 +1833,7 @@ class VideoGen(BaseGen):
                     },
                     {
                         "name": "camera_json",
-                        "value": '{"type":"empty","horizontal":0,"vertical":0,"zoom":0,"tilt":0,"pan":0,"roll":0}',
+                        "value": camera_json,
                     },
                     {
                         "name": "biz",
@@ -315,10 +1851,7 @@ class VideoGen(BaseGen):
             }
 
         else:
-            if is_high_quality:
-                model_type = "m2v_txt2video_hq"
-            else:
-                model_type = "m2v_txt2video"
+            self._check_points(model_type, int(duration) / 5)
             payload = {
                 "arguments": [
                     {"name": "prompt", "value": prompt},
@@ -328,11 +1861,11 @@ class VideoGen(BaseGen):
                     },
                     {
                         "name": "cfg",
-                        "value": "0.5",
+                        "value": str(cfg),
                     },
                     {
                         "name": "duration",
-                        "value": "5",
+                        "value": str(duration),
                     },
                     {
                         "name": "kling_version",
@@ -340,11 +1873,11 @@ class VideoGen(BaseGen):
                     },
                     {
                         "name": "aspect_ratio",
-                        "value": "16:9",
+                        "value": aspect_ratio,
                     },
                     {
                         "name": "camera_json",
-                        "value": '{"type":"empty","horizontal":0,"vertical":0,"zoom":0,"tilt":0,"pan":0,"roll":0}',
+                        "value": camera_json,
                     },
                     {
                         "name": "biz",
@@ -354,14 +1887,109 @@ class VideoGen(BaseGen):
                 "inputs": [],
                 "type": model_type,
             }
+        return payload
+
+    def get_video(
+        self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        image_url: Optional[str] = None,
+        is_high_quality: bool = False,
+        auto_extend: bool = False,
+        model_name: str = "1.0",
+        cfg: float = 0.5,
+        duration: int = 5,
+        aspect_ratio: str = "16:9",
+        camera: Optional[dict] = None,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ) -> list:
+        self.session.headers["user-agent"] = ua.random
+        payload = self._build_video_payload(
+            prompt,
+            image_path=image_path,
+            image_url=image_url,
+            is_high_quality=is_high_quality,
+            model_name=model_name,
+            cfg=cfg,
+            duration=duration,
+            aspect_ratio=aspect_ratio,
+            camera=camera,
+        )
         if auto_extend:
             print("will generate and extending video...")
-            self._get_video_with_payload(payload)
+            self._get_video_with_payload(payload, timeout, cancel)
             print("Auto extending video...")
             video_id = self.video_id_list.pop()
-            return self.extend_video(video_id)
+            return self.extend_video(video_id, timeout=timeout, cancel=cancel)
         else:
-            return self._get_video_with_payload(payload)
+            return self._get_video_with_payload(payload, timeout, cancel)
+
+    def submit_video(
+        self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        image_url: Optional[str] = None,
+        is_high_quality: bool = False,
+        model_name: str = "1.0",
+        cfg: float = 0.5,
+        duration: int = 5,
+        aspect_ratio: str = "16:9",
+        camera: Optional[dict] = None,
+    ) -> TaskHandle:
+        """
+        submit without waiting, collect it later with wait / result
+        """
+        self.session.headers["user-agent"] = ua.random
+        return self._submit_handle(
+            self._build_video_payload(
+                prompt,
+                image_path=image_path,
+                image_url=image_url,
+                is_high_quality=is_high_quality,
+                model_name=model_name,
+                cfg=cfg,
+                duration=duration,
+                aspect_ratio=aspect_ratio,
+                camera=camera,
+            )
+        )
+
+    def iter_videos(
+        self,
+        jobs: list,
+        max_workers: int = 4,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[WorkResult]:
+        """
+        submit many jobs and yield every video as soon as its task is done,
+        each job is a dict of `get_video` arguments except `auto_extend`
+        """
+        self.session.headers["user-agent"] = ua.random
+        return self._iter_jobs(
+            self._build_video_payload, jobs, max_workers, timeout, cancel
+        )
+
+    def sweep_videos(
+        self,
+        grid: dict,
+        max_workers: int = 4,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[WorkResult]:
+        """
+        run every combination of the grid, e.g.
+        {"prompt": ["a cat", "a dog"], "is_high_quality": [False, True], "cfg": [0.3, 0.7]}
+        """
+        self.session.headers["user-agent"] = ua.random
+        return self._sweep(
+            self._build_video_payload,
+            grid,
+            max_workers,
+            timeout=timeout,
+            cancel=cancel,
+        )
 
     def save_video(
         self,
@@ -372,6 +2000,8 @@ class VideoGen(BaseGen):
         is_high_quality: bool = False,
         auto_extend: bool = False,
         model_name: str = "1.0",
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
     ) -> None:
         mp4_index = 0
         try:
@@ -382,6 +2012,8 @@ class VideoGen(BaseGen):
                 is_high_quality=is_high_quality,
                 auto_extend=auto_extend,
                 model_name=model_name,
+                timeout=timeout,
+                cancel=cancel,
             )
         except Exception as e:
             print(e)
@@ -395,24 +2027,38 @@ class VideoGen(BaseGen):
         link = links[0]
         while os.path.exists(os.path.join(output_dir, f"{mp4_index}.mp4")):
             mp4_index += 1
-        response = self.session.get(link)
-        if response.status_code != 200:
-            raise Exception("Could not download image")
-        # save response to file
-        with open(os.path.join(output_dir, f"{mp4_index}.mp4"), "wb") as output_file:
-            output_file.write(response.content)
+        if cancel is not None and cancel.cancelled:
+            raise TaskCancelled("Request cancelled")
+        self._download(link, os.path.join(output_dir, f"{mp4_index}.mp4"), cancel)
         mp4_index += 1
 
 
 class ImageGen(BaseGen):
-    def get_images(
+    # the most images kling makes in one task
+    max_images_per_task = 4
+
+    def estimate_cost(self, job: dict) -> float:
+        if job.get("image_path") or job.get("image_url"):
+            task_type = "mmu_img2img_aiweb"
+        else:
+            task_type = "mmu_txt2img_aiweb"
+        return self.ledger.cost(task_type, int(job.get("image_count", 4)) / 4)
+
+    def cost_units(self, payload: dict) -> float:
+        # 4 images are one unit
+        return int(self._payload_argument(payload, "imageCount") or 4) / 4
+
+    def _build_image_payload(
         self,
         prompt: str,
         image_path: Optional[str] = None,
         image_url: Optional[str] = None,
-    ) -> list:
-        self.session.headers["user-agent"] = ua.random
+        aspect_ratio: str = "1:1",
+        image_count: int = 4,
+        style: str = "默认",
+    ) -> dict:
         if image_path or image_url:
+            self._check_points("mmu_img2img_aiweb", image_count / 4)
             if image_path:
                 image_payload_url = self.image_uploader(image_path)
             else:
@@ -422,15 +2068,15 @@ class ImageGen(BaseGen):
                     {"name": "prompt", "value": prompt},
                     {
                         "name": "style",
-                        "value": "默认",
+                        "value": style,
                     },
                     {
                         "name": "aspect_ratio",
-                        "value": "1:1",
+                        "value": aspect_ratio,
                     },
                     {
                         "name": "imageCount",
-                        "value": "4",
+                        "value": str(image_count),
                     },
                     {
                         "name": "fidelity",
@@ -451,6 +2097,7 @@ class ImageGen(BaseGen):
                 ],
             }
         else:
+            self._check_points("mmu_txt2img_aiweb", image_count / 4)
             payload = {
                 "arguments": [
                     {
@@ -459,15 +2106,15 @@ class ImageGen(BaseGen):
                     },
                     {
                         "name": "style",
-                        "value": "默认",
+                        "value": style,
                     },
                     {
                         "name": "aspect_ratio",
-                        "value": "1:1",
+                        "value": aspect_ratio,
                     },
                     {
                         "name": "imageCount",
-                        "value": "4",
+                        "value": str(image_count),
                     },
                     {
                         "name": "biz",
@@ -477,48 +2124,133 @@ class ImageGen(BaseGen):
                 "type": "mmu_txt2img_aiweb",
                 "inputs": [],
             }
+        return payload
 
-        response = self.session.post(
-            self.submit_url,
-            json=payload,
+    def get_images(
+        self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        image_url: Optional[str] = None,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+        count: int = 4,
+        max_workers: int = 4,
+    ) -> list:
+        """
+        more than max_images_per_task images are split into concurrent tasks,
+        the urls come back in task order, raises if some of them are missing,
+        max_workers only limits the submits, every task runs on the account at
+        once unless a scheduler is set
+        """
+        if count < 1:
+            raise Exception(f"count must be at least 1, got {count}")
+        self.session.headers["user-agent"] = ua.random
+        if count > self.max_images_per_task:
+            return self._get_many_images(
+                prompt, image_path, image_url, timeout, cancel, count, max_workers
+            )
+        payload = self._build_image_payload(
+            prompt, image_path, image_url, image_count=count
         )
-        if not response.ok:
-            print(response.text)
-            raise Exception(f"Error response {str(response)}")
-        response_body = response.json()
-        if response_body.get("data").get("status") == 7:
-            message = response_body.get("data").get("message")
-            raise Exception(f"Request failed message {message}")
-        request_id = (response_body.get("data", {}).get("task") or {}).get("id")
-        if not request_id:
-            raise Exception("Could not get request ID")
-        start_wait = time.time()
+        request_id = self._scheduled_submit(payload, Priority.INTERACTIVE, cancel)
         print("Waiting for results...")
-        while True:
-            if int(time.time() - start_wait) > 1200:
-                raise Exception("Request timeout")
-            image_data, status = self.fetch_metadata(request_id)
-            if status == TaskStatus.PENDING:
-                print(".", end="", flush=True)
-                # spider rule
-                time.sleep(2)
-            elif status == TaskStatus.FAILED:
-                print("Request failed")
-                return []
-            else:
-                result = []
-                works = image_data.get("works", [])
-                if not works:
-                    print("No images found.")
-                    return []
-                else:
-                    for work in works:
-                        resource = work.get("resource", {}).get("resource")
-                        if resource:
-                            # sleep for 2s for waiting the video to be ready in kuaishou server
-                            time.sleep(2)
-                            result.append(resource)
-                return result
+        return self.wait_for_task(request_id, timeout, cancel, kind="images")
+
+    def _get_many_images(
+        self,
+        prompt: str,
+        image_path: Optional[str],
+        image_url: Optional[str],
+        timeout: float,
+        cancel: Optional[CancelToken],
+        count: int,
+        max_workers: int,
+    ) -> list:
+        if image_path:
+            # upload once, every task uses the same url
+            self._check_points("mmu_img2img_aiweb", count / 4)
+            image_url = self.image_uploader(image_path)
+        jobs = [
+            {
+                "prompt": prompt,
+                "image_url": image_url,
+                "image_count": min(self.max_images_per_task, count - start),
+            }
+            for start in range(0, count, self.max_images_per_task)
+        ]
+        print(f"Waiting for {count} images from {len(jobs)} tasks...")
+        results = [[] for _ in jobs]
+        unfinished_before = len(self.unfinished_tasks)
+        failed_before = len(self.failed_jobs)
+        # still a single blocking call, served before batch work
+        for work in self._iter_jobs(
+            self._build_image_payload,
+            jobs,
+            max_workers,
+            timeout,
+            cancel,
+            Priority.INTERACTIVE,
+        ):
+            results[work.job_index].append(work.url)
+        links = [url for urls in results for url in urls]
+        if len(links) < count:
+            unfinished = self.unfinished_tasks[unfinished_before:]
+            failed = [str(e) for _, e in self.failed_jobs[failed_before:]]
+            raise Exception(
+                f"Got {len(links)} of {count} images, "
+                f"unfinished tasks {unfinished}, failed {failed}"
+            )
+        return links
+
+    def submit_images(
+        self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        image_url: Optional[str] = None,
+    ) -> TaskHandle:
+        """
+        submit without waiting, collect it later with wait / result
+        """
+        self.session.headers["user-agent"] = ua.random
+        return self._submit_handle(
+            self._build_image_payload(prompt, image_path, image_url)
+        )
+
+    def iter_images(
+        self,
+        jobs: list,
+        max_workers: int = 4,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[WorkResult]:
+        """
+        submit many jobs and yield every image as soon as its task is done,
+        each job is a dict of `get_images` arguments
+        """
+        self.session.headers["user-agent"] = ua.random
+        return self._iter_jobs(
+            self._build_image_payload, jobs, max_workers, timeout, cancel
+        )
+
+    def sweep_images(
+        self,
+        grid: dict,
+        max_workers: int = 4,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[WorkResult]:
+        """
+        run every combination of the grid, e.g.
+        {"prompt": ["a cat", "a dog"], "aspect_ratio": ["1:1", "16:9"]}
+        """
+        self.session.headers["user-agent"] = ua.random
+        return self._sweep(
+            self._build_image_payload,
+            grid,
+            max_workers,
+            timeout=timeout,
+            cancel=cancel,
+        )
 
     def save_images(
         self,
@@ -526,10 +2258,16 @@ class ImageGen(BaseGen):
         output_dir: str,
         image_path: Optional[str] = None,
         image_url: Optional[str] = None,
+        timeout: float = 1200,
+        cancel: Optional[CancelToken] = None,
+        count: int = 4,
+        max_workers: int = 4,
     ) -> None:
         png_index = 0
         try:
-            links = self.get_images(prompt, image_path, image_url)
+            links = self.get_images(
+                prompt, image_path, image_url, timeout, cancel, count, max_workers
+            )
         except Exception as e:
             print(e)
             raise
@@ -538,12 +2276,9 @@ class ImageGen(BaseGen):
         print()
 
         def download_image(link: str, index: int) -> None:
-            response = self.session.get(link)
-            if response.status_code != 200:
-                raise Exception("Could not download image")
-            # save response to file
-            with open(os.path.join(output_dir, f"{index}.png"), "wb") as output_file:
-                output_file.write(response.content)
+            # a cancel just ends the download thread
+            with contextlib.suppress(TaskCancelled):
+                self._download(link, os.path.join(output_dir, f"{index}.png"), cancel)
 
         threads = []
         for link in links:
@@ -560,6 +2295,87 @@ class ImageGen(BaseGen):
             thread.join()
 
 
+def run(args: argparse.Namespace) -> None:
+    if args.log_stats:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    def progress_view(generator: BaseGen):
+        if args.live:
+            return generator.progress.live()
+        if args.log_stats:
+            return generator.progress.log_every(args.log_stats)
+        return contextlib.nullcontext()
+
+    if args.sweep or args.s3_bucket:
+        grid = {}
+        if args.sweep:
+            with open(args.sweep) as f:
+                grid = json.load(f)
+        if args.prompt:
+            grid.setdefault("prompt", args.prompt)
+        if args.I:
+            grid.setdefault("image_path", args.I)
+        if args.type == "image":
+            generator = ImageGen(os.environ.get("KLING_COOKIE") or args.U)
+            sweep = generator.sweep_images
+        else:
+            generator = VideoGen(os.environ.get("KLING_COOKIE") or args.U)
+            sweep = generator.sweep_videos
+            grid.setdefault("is_high_quality", args.high_quality)
+            grid.setdefault("model_name", args.model_name)
+        generator.image_max_size = args.image_max_size
+        with progress_view(generator):
+            results = sweep(grid, timeout=args.timeout)
+            if args.s3_bucket:
+                sink = S3Sink(
+                    args.s3_bucket, args.s3_prefix, endpoint_url=args.s3_endpoint
+                )
+                results = generator.mirror(results, sink)
+            for result in results:
+                print(result.params, result.key or result.url)
+        print(
+            f"The balance of points in your account is: {generator.get_account_point(refresh=True)}"
+        )
+        return
+
+    # Create video and image generator
+    # follow old style
+    if args.type == "image":
+        image_generator = ImageGen(
+            os.environ.get("KLING_COOKIE") or args.U,
+        )
+        image_generator.image_max_size = args.image_max_size
+        with progress_view(image_generator):
+            image_generator.save_images(
+                prompt=args.prompt,
+                output_dir=args.output_dir,
+                image_path=args.I,
+                timeout=args.timeout,
+                count=args.count,
+            )
+        print(
+            f"The balance of points in your account is: {image_generator.get_account_point(refresh=True)}"
+        )
+    else:
+        video_generator = VideoGen(
+            os.environ.get("KLING_COOKIE") or args.U,
+        )
+        video_generator.image_max_size = args.image_max_size
+        with progress_view(video_generator):
+            video_generator.save_video(
+                prompt=args.prompt,
+                output_dir=args.output_dir,
+                image_path=args.I,
+                is_high_quality=args.high_quality,
+                auto_extend=args.auto_extend,
+                model_name=args.model_name,
+                timeout=args.timeout,
+            )
+        print(
+            f"The balance of points in your account is: {video_generator.get_account_point(refresh=True)}"
+        )
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-U", help="Auth cookie from browser", type=str, default="")
@@ -585,7 +2401,7 @@ def main():
         "--prompt",
         help="Prompt to generate images for",
         type=str,
-        required=True,
+        default="",
     )
 
     parser.add_argument(
@@ -604,38 +2420,73 @@ def main():
         help="Auto extend video",
         action="store_true",
     )
+    parser.add_argument(
+        "--image-max-size",
+        help="Downscale the -I image to this longer side before upload, needs Pillow",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--count",
+        help="Number of images, more than 4 are made by concurrent tasks",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--sweep",
+        help="JSON file with a grid of get_video/get_images arguments to run, "
+        'e.g. {"prompt": ["a cat", "a dog"], "cfg": [0.3, 0.7]}',
+        type=str,
+        default="",
+    )
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--timeout",
+        help="Seconds to wait for each task, the task id is printed on timeout",
+        type=float,
+        default=1200,
+    )
+    parser.add_argument(
+        "--s3-bucket",
+        help="Mirror the results into this S3 bucket instead of --output-dir, needs boto3",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--s3-prefix",
+        help="Key prefix for --s3-bucket",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--s3-endpoint",
+        help="Endpoint url of an S3 compatible store, e.g. minio",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--trace",
+        help="Write a chrome trace of every http call, sleep and phase to this file",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--live",
+        help="Show a live table of the running tasks",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--log-stats",
+        help="Log progress stats as json every N seconds, for headless runs",
+        type=int,
+        default=0,
+    )
 
-    # Create video and image generator
-    # follow old style
-    if args.type == "image":
-        image_generator = ImageGen(
-            os.environ.get("KLING_COOKIE") or args.U,
-        )
-        image_generator.save_images(
-            prompt=args.prompt,
-            output_dir=args.output_dir,
-            image_path=args.I,
-        )
-        print(
-            f"The balance of points in your account is: {image_generator.get_account_point()}"
-        )
-    else:
-        video_generator = VideoGen(
-            os.environ.get("KLING_COOKIE") or args.U,
-        )
-        video_generator.save_video(
-            prompt=args.prompt,
-            output_dir=args.output_dir,
-            image_path=args.I,
-            is_high_quality=args.high_quality,
-            auto_extend=args.auto_extend,
-            model_name=args.model_name,
-        )
-        print(
-            f"The balance of points in your account is: {video_generator.get_account_point()}"
-        )
+    args = parser.parse_args()
+    if not args.prompt and not args.sweep:
+        parser.error("--prompt is required")
+    with trace(args.trace) if args.trace else contextlib.nullcontext():
+        run(args)
 
 
 if __name__ == "__main__":
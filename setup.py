@@ -12,6 +12,10 @@ setup(
         "fake-useragent",
         "rich",
     ],
+    extras_require={
+        "preprocess": ["pillow"],
+        "s3": ["boto3"],
+    },
     packages=find_packages(exclude=["tests", "tests.*"]),
     entry_points={
         "console_scripts": ["kling = kling.kling:main"],
@@ -1,14 +1,54 @@
+import io
+import itertools
+import json
 import sys
 import os
+import threading
+import time
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from kling import ImageGen, VideoGen, BaseGen, call_for_daily_check, TaskStatus
+from kling import (
+    ImageGen,
+    VideoGen,
+    BaseGen,
+    call_for_daily_check,
+    TaskStatus,
+    WorkResult,
+    PointLedger,
+    preprocess_image,
+    expand_grid,
+    ProgressTracker,
+    CancelToken,
+    TaskCancelled,
+    TaskTimeout,
+    S3Sink,
+    TaskHandle,
+    Priority,
+    Scheduler,
+    trace,
+)
 
 import pytest
+import requests
 from unittest.mock import patch, MagicMock, mock_open
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("KLING_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+_fetch_account_point = BaseGen._fetch_account_point
+
+
+@pytest.fixture(autouse=True)
+def account_point(monkeypatch):
+    # the first submit fetches the balance, plenty of points unless a test says so
+    monkeypatch.setattr(BaseGen, "_fetch_account_point", lambda self: 1000.0)
+
+
 @pytest.fixture
 def mock_session():
     with patch("requests.Session") as mock:
@@ -57,13 +97,110 @@ def test_parse_cookie_string():
 
 
 @pytest.mark.parametrize("gen_class", [ImageGen, VideoGen])
-def test_get_account_point(gen_class, mock_session):
+def test_get_account_point(gen_class, mock_session, monkeypatch):
+    monkeypatch.setattr(BaseGen, "_fetch_account_point", _fetch_account_point)
     gen = gen_class("mock_cookie")
+    # the daily check already ran today in __init__
     mock_session.get.return_value.json.side_effect = [
-        {"status": 200},
         {"status": 200, "data": {"total": 1000}},
     ]
     assert gen.get_account_point() == 10.0
+    # cached, no more round trips
+    calls = mock_session.get.call_count
+    assert gen.get_account_point() == 10.0
+    assert mock_session.get.call_count == calls
+
+
+@patch("kling.kling.call_for_daily_check", return_value=True)
+def test_daily_check_once_per_day(mock_daily, mock_session):
+    BaseGen("kuaishou_st=value1")
+    gen = BaseGen("kuaishou_st=value1")
+    mock_daily.assert_called_once()
+    assert gen.is_cn
+
+    # another account has its own state
+    BaseGen("other_st=value2")
+    assert mock_daily.call_count == 2
+
+
+@patch("kling.kling.call_for_daily_check", return_value=True)
+def test_session_state_shared(mock_daily, mock_session):
+    gen = BaseGen("kuaishou_st=value1")
+    gen.session.cookies.set("kuaishou_st", "refreshed")
+    gen.save_session_state()
+
+    worker = BaseGen("kuaishou_st=value1")
+    assert worker.session.cookies["kuaishou_st"] == "refreshed"
+    assert worker.is_cn
+
+
+def test_point_ledger_learns_cost():
+    ledger = PointLedger()
+    ledger.sync(100.0)
+    ledger.reserve("m2v_txt2video")
+    ledger.reserve("m2v_txt2video")
+    ledger.sync(80.0)
+    assert ledger.costs["m2v_txt2video"] == 10.0
+
+    ledger.reserve("m2v_txt2video")
+    assert ledger.balance == 70.0
+    ledger.release("m2v_txt2video")
+    assert ledger.balance == 80.0
+
+
+def test_point_ledger_cost_per_duration():
+    ledger = PointLedger()
+    ledger.sync(100.0)
+    # a 10s video is two units
+    ledger.reserve("m2v_txt2video", 2)
+    ledger.reserve("m2v_txt2video", 1)
+    ledger.sync(70.0)
+    assert ledger.costs["m2v_txt2video"] == 10.0
+    with pytest.raises(Exception):
+        ledger.check("m2v_txt2video", 8)
+
+
+def test_point_ledger_rejects_overdraw():
+    ledger = PointLedger(costs={"m2v_txt2video_hq": 35})
+    ledger.sync(20.0)
+    with pytest.raises(Exception):
+        ledger.reserve("m2v_txt2video_hq")
+    assert ledger.balance == 20.0
+
+
+@patch.object(VideoGen, "image_uploader")
+def test_get_video_rejected_before_upload(mock_uploader, video_gen, mock_session):
+    video_gen.ledger = PointLedger(costs={"m2v_img2video": 10})
+    video_gen.ledger.sync(5.0)
+
+    with pytest.raises(Exception):
+        video_gen.get_video("mock_prompt", image_path="mock_image.jpg")
+    mock_uploader.assert_not_called()
+    mock_session.post.assert_not_called()
+
+
+def test_failed_task_points_given_back(video_gen, mock_session):
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    handle = video_gen.submit_video("mock_prompt")
+    assert video_gen.ledger.balance == 990.0
+
+    mock_session.get.return_value.json.return_value = {"data": {"status": 50}}
+    assert video_gen.poll_once(handle) == TaskStatus.FAILED
+    assert video_gen.ledger.balance == 1000.0
+    # only once
+    video_gen.poll_once(handle)
+    assert video_gen.ledger.balance == 1000.0
+
+
+def test_first_submit_fetches_balance(video_gen, monkeypatch):
+    # estimated costs reject an hq video before anything is sent
+    monkeypatch.setattr(BaseGen, "_fetch_account_point", lambda self: 1.0)
+    with pytest.raises(Exception):
+        video_gen.submit_video("mock_prompt", is_high_quality=True)
+    assert video_gen.ledger.balance == 1.0
+    video_gen.session.post.assert_not_called()
 
 
 @patch("builtins.open", new_callable=MagicMock)
@@ -80,6 +217,114 @@ def test_image_uploader(mock_open, image_gen, mock_session):
     assert result == "mock_url"
 
 
+@patch("builtins.open", new_callable=MagicMock)
+def test_image_uploader_reuses_upload(mock_open, image_gen, mock_session):
+    mock_open.return_value.__enter__.return_value.read.return_value = b"image_data"
+    mock_session.get.return_value.json.side_effect = [
+        {"status": 200, "data": {"token": "mock_token"}},
+        {"result": 1},
+        {"status": 200, "data": {"url": "mock_url"}},
+    ]
+    mock_session.post.return_value.json.side_effect = [{"result": 1}, {"result": 1}]
+
+    assert image_gen.image_uploader("a.png") == "mock_url"
+    # same bytes, no second upload
+    assert image_gen.image_uploader("b.png") == "mock_url"
+    assert mock_session.post.call_count == 2
+
+
+def test_preprocess_image(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    source = tmp_path / "big.png"
+    Image.new("RGB", (4000, 3000), (255, 0, 0)).save(source)
+
+    first = preprocess_image(str(source), 1024, str(tmp_path / "out"))
+    second = preprocess_image(str(source), 1024, str(tmp_path / "out"))
+    assert first == second
+    with Image.open(first) as image:
+        assert image.size == (1024, 768)
+        assert image.format == "JPEG"
+        assert not image.getexif()
+    assert os.listdir(tmp_path / "out") == [os.path.basename(first)]
+
+
+def test_preprocess_image_flattens_alpha(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    source = tmp_path / "clear.png"
+    Image.new("RGBA", (100, 100), (0, 0, 0, 0)).save(source)
+
+    output = preprocess_image(str(source), 1024, str(tmp_path / "out"))
+    with Image.open(output) as image:
+        red, green, blue = image.getpixel((50, 50))
+        assert min(red, green, blue) > 250
+
+
+@patch("kling.kling.time.sleep")
+@patch.object(ImageGen, "image_uploader", return_value="mock_image_url")
+def test_iter_images_preprocess(
+    mock_uploader, mock_sleep, image_gen, mock_session, tmp_path
+):
+    Image = pytest.importorskip("PIL.Image")
+    source = tmp_path / "big.png"
+    Image.new("RGB", (2000, 1000)).save(source)
+    image_gen.image_max_size = 512
+    image_gen.work_ready_delay = 0
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+
+    results = list(image_gen.iter_images([{"prompt": "a", "image_path": str(source)}]))
+    assert [r.url for r in results] == ["mock_url"]
+    prepared = image_gen._prepared_images[str(source)]
+    with Image.open(prepared) as image:
+        assert image.size == (512, 256)
+
+
+@patch("builtins.open", new_callable=MagicMock)
+@patch("kling.kling.preprocess_image", return_value="small.jpg")
+def test_image_uploader_preprocesses_once(
+    mock_preprocess, mock_open, image_gen, mock_session
+):
+    mock_open.return_value.__enter__.return_value.read.return_value = b"image_data"
+    mock_session.get.return_value.json.side_effect = [
+        {"status": 200, "data": {"token": "mock_token"}},
+        {"result": 1},
+        {"status": 200, "data": {"url": "mock_url"}},
+    ]
+    mock_session.post.return_value.json.side_effect = [{"result": 1}, {"result": 1}]
+    image_gen.image_max_size = 512
+
+    assert image_gen.image_uploader("big.png") == "mock_url"
+    assert image_gen.image_uploader("big.png") == "mock_url"
+    mock_preprocess.assert_called_once()
+
+
+@patch("builtins.open", new_callable=MagicMock)
+def test_prewarm_prefetches_upload_tokens(mock_open, image_gen, mock_session):
+    mock_session.get.return_value.json.side_effect = [
+        {"status": 200, "data": {"token": "prefetched"}},
+        {"result": 1},
+    ]
+    image_gen.prewarm(upload_tokens=1, connections=1, background=False)
+    assert [call.args[0] for call in mock_session.head.call_args_list] == [
+        image_gen.base_url,
+        image_gen.image_upload_base_url,
+    ]
+
+    mock_open.return_value.__enter__.return_value.read.return_value = b"image_data"
+    mock_session.get.return_value.json.side_effect = [
+        {"status": 200, "data": {"url": "mock_url"}},
+    ]
+    mock_session.post.return_value.json.side_effect = [{"result": 1}, {"result": 1}]
+    assert image_gen.image_uploader("mock_image_path") == "mock_url"
+    assert mock_session.post.call_args_list[0].kwargs["params"] == dict(
+        upload_token="prefetched", fragment_id=0
+    )
+
+
 def test_fetch_metadata(base_gen, mock_session):
     mock_session.get.return_value.json.return_value = {
         "data": {"status": 100, "key": "value"}
@@ -187,7 +432,7 @@ def test_video_gen_save_video(
     mock_session.get.return_value.json.return_value = {
         "data": {"status": 100, "works": [{"resource": {"resource": "mock_video_url"}}]}
     }
-    mock_session.get.return_value.content = b"mock_video_content"
+    mock_session.get.return_value.iter_content.return_value = [b"mock_video_content"]
     mock_session.get.return_value.status_code = 200
 
     video_gen.save_video("mock_prompt", "mock_output_dir")
@@ -285,5 +530,734 @@ def test_extend_video_no_works(mock_fetch_metadata, video_gen):
         video_gen.extend_video(123, "mock_prompt")
 
 
+@patch("kling.kling.time.sleep")
+def test_iter_images_yields_as_completed(mock_sleep, image_gen, mock_session):
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": "task_a"}}},
+        {"data": {"task": {"id": "task_b"}}},
+    ]
+    task_b_done = threading.Event()
+
+    def fake_get(url):
+        task_id = url.split("taskId=")[-1]
+        response = MagicMock()
+        if task_id == "task_b":
+            task_b_done.set()
+            response.json.return_value = {
+                "data": {
+                    "status": 99,
+                    "works": [
+                        {"resource": {"resource": "b0"}},
+                        {"resource": {"resource": "b1"}},
+                    ],
+                }
+            }
+        elif task_b_done.is_set():
+            response.json.return_value = {
+                "data": {"status": 99, "works": [{"resource": {"resource": "a0"}}]}
+            }
+        else:
+            response.json.return_value = {"data": {"status": 5}}
+        return response
+
+    mock_session.get.side_effect = fake_get
+    image_gen.poll_interval = 0
+    image_gen.work_ready_delay = 0
+
+    results = list(
+        image_gen.iter_images([{"prompt": "a"}, {"prompt": "b"}], max_workers=1)
+    )
+    assert results == [
+        WorkResult(1, "task_b", "b0"),
+        WorkResult(1, "task_b", "b1"),
+        WorkResult(0, "task_a", "a0"),
+    ]
+
+
+@patch("kling.kling.time.sleep")
+def test_iter_videos_skips_failed(mock_sleep, video_gen, mock_session):
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.return_value = {"data": {"status": 50}}
+
+    assert list(video_gen.iter_videos([{"prompt": "a"}])) == []
+    assert video_gen.failed_jobs[0][0] == 0
+
+
+@patch("kling.kling.time.sleep")
+def test_iter_videos_keeps_going_after_failed_submit(
+    mock_sleep, video_gen, mock_session
+):
+    failed = MagicMock(ok=False)
+    submitted = MagicMock()
+    submitted.json.return_value = {"data": {"task": {"id": "mock_id"}}}
+    mock_session.post.side_effect = [failed, submitted]
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+    video_gen.poll_interval = 0
+    video_gen.work_ready_delay = 0
+
+    results = list(
+        video_gen.iter_videos([{"prompt": "a"}, {"prompt": "b"}], max_workers=1)
+    )
+    assert results == [WorkResult(1, "mock_id", "mock_url")]
+    assert [job_index for job_index, _ in video_gen.failed_jobs] == [0]
+
+
+@patch("kling.kling.time.sleep")
+def test_iter_videos_retries_poll_errors(mock_sleep, video_gen, mock_session):
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": "flaky"}}},
+        {"data": {"task": {"id": "broken"}}},
+    ]
+    flaky_errors = [requests.ConnectionError()]
+
+    def fake_get(url):
+        if url.endswith("broken"):
+            raise requests.ConnectionError()
+        if flaky_errors:
+            raise flaky_errors.pop()
+        response = MagicMock()
+        response.json.return_value = {
+            "data": {"status": 99, "works": [{"resource": {"resource": "url"}}]}
+        }
+        return response
+
+    mock_session.get.side_effect = fake_get
+    video_gen.poll_interval = 0
+    video_gen.work_ready_delay = 0
+
+    results = list(
+        video_gen.iter_videos([{"prompt": "a"}, {"prompt": "b"}], max_workers=1)
+    )
+    assert [r.task_id for r in results] == ["flaky"]
+    # given up after max_poll_errors, it may still be running
+    assert video_gen.unfinished_tasks == ["broken"]
+
+
+def test_expand_grid():
+    jobs = expand_grid(
+        {"prompt": ["a", "b", "a"], "is_high_quality": [False, True], "cfg": 0.5}
+    )
+    assert jobs == [
+        {"prompt": "a", "is_high_quality": False, "cfg": 0.5},
+        {"prompt": "a", "is_high_quality": True, "cfg": 0.5},
+        {"prompt": "b", "is_high_quality": False, "cfg": 0.5},
+        {"prompt": "b", "is_high_quality": True, "cfg": 0.5},
+    ]
+
+
+def test_build_video_payload_settings(video_gen):
+    payload = video_gen._build_video_payload(
+        "mock_prompt",
+        cfg=0.8,
+        duration=10,
+        aspect_ratio="9:16",
+        camera={"type": "zoom", "zoom": 5},
+    )
+    arguments = {arg["name"]: arg["value"] for arg in payload["arguments"]}
+    assert arguments["cfg"] == "0.8"
+    assert arguments["duration"] == "10"
+    assert arguments["aspect_ratio"] == "9:16"
+    assert arguments["camera_json"] == (
+        '{"type":"zoom","horizontal":0,"vertical":0,"zoom":5,"tilt":0,"pan":0,"roll":0}'
+    )
+
+
+@patch("kling.kling.time.sleep")
+def test_sweep_videos_cheapest_first(mock_sleep, video_gen, mock_session):
+    video_gen.poll_interval = 0
+    video_gen.work_ready_delay = 0
+    submitted = []
+
+    def fake_post(url, json):
+        submitted.append(json["type"])
+        response = MagicMock()
+        response.json.return_value = {"data": {"task": {"id": json["type"]}}}
+        return response
+
+    mock_session.post.side_effect = fake_post
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+
+    results = list(
+        video_gen.sweep_videos(
+            {"prompt": "a", "is_high_quality": [True, False]}, max_workers=1
+        )
+    )
+    assert submitted == ["m2v_txt2video", "m2v_txt2video_hq"]
+    assert sorted(r.params["is_high_quality"] for r in results) == [False, True]
+
+
+def test_sweep_checks_keys_and_drops_same_payloads(video_gen, mock_session):
+    with pytest.raises(Exception, match="duraton"):
+        video_gen.sweep_videos({"prompt": "a", "duraton": [5, 10]})
+    mock_session.post.assert_not_called()
+
+    with patch.object(VideoGen, "_iter_jobs", return_value=iter([])) as iter_jobs:
+        list(
+            video_gen.sweep_videos(
+                {
+                    "prompt": "a",
+                    "image_url": "http://mock.com/image.jpg",
+                    "aspect_ratio": ["16:9", "1:1"],
+                    "cfg": [0.5, "0.5"],
+                }
+            )
+        )
+    assert len(iter_jobs.call_args.args[1]) == 1
+
+
+def test_progress_tracker():
+    tracker = ProgressTracker()
+    tracker.start("t1", "m2v_txt2video", 300)
+    tracker.start("t2", "m2v_txt2video", 300)
+    tracker.record_poll("t1", TaskStatus.PENDING)
+    tracker.record_poll("t1", TaskStatus.COMPLETED)
+    tracker.record_poll("t2", TaskStatus.FAILED)
+    tracker.record_poll("t2")
+    tracker.add_work("t1", "url1")
+    tracker.add_bytes("url1", 1024)
+
+    stats = tracker.stats()
+    assert stats["in_flight"] == 1
+    assert stats["finished"] == 1
+    assert stats["failed"] == 1
+    assert stats["error_rate"] == 0.25
+    assert stats["bytes_downloaded"] == 1024
+    assert tracker.tasks["t1"]["phase"] == "downloading"
+    assert tracker.render().row_count == 1
+
+
+def test_progress_tracker_finish():
+    tracker = ProgressTracker()
+    tracker.start("task_a", "m2v_txt2video", 300)
+    tracker.start("task_b", "m2v_txt2video", 300)
+    tracker.finish("task_a", "timeout")
+    assert tracker.stats()["in_flight"] == 1
+    assert tracker.tasks["task_a"]["phase"] == "timeout"
+
+    # bytes show up while the download is still running
+    tracker.add_work("task_b", "url")
+    tracker.add_bytes("url", 1024)
+    assert tracker.tasks["task_b"]["phase"] == "downloading"
+    assert tracker.stats()["bytes_downloaded"] == 1024
+
+
+@patch("kling.kling.time.sleep")
+def test_get_video_tracks_progress(mock_sleep, video_gen, mock_session):
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+
+    video_gen.get_video("mock_prompt")
+    assert video_gen.progress.finished == 1
+    assert video_gen.progress.tasks["mock_id"]["phase"] == "ready"
+
+
+def test_get_images_timeout_returns_task_id(image_gen, mock_session):
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.return_value = {"data": {"status": 5}}
+
+    with pytest.raises(TaskTimeout) as exc_info:
+        image_gen.get_images("mock_prompt", timeout=0)
+    assert exc_info.value.task_id == "mock_id"
+    assert image_gen.unfinished_tasks == ["mock_id"]
+
+
+def test_deadline_passes_before_poll_sleep(image_gen, mock_session):
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.return_value = {"data": {"status": 5}}
+
+    # a slow terminal write runs past the deadline right before the sleep
+    with patch("kling.kling.print", side_effect=lambda *a, **k: time.sleep(0.02)):
+        with pytest.raises(TaskTimeout):
+            image_gen.get_images("mock_prompt", timeout=0.01)
+
+
+def test_cancel_wakes_up_polling(video_gen, mock_session):
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.return_value = {"data": {"status": 5}}
+    cancel = CancelToken()
+    threading.Timer(0.1, cancel.cancel).start()
+
+    start = time.time()
+    with pytest.raises(TaskCancelled):
+        video_gen.get_video("mock_prompt", cancel=cancel)
+    assert time.time() - start < video_gen.poll_interval
+
+
+@patch("kling.kling.time.sleep")
+def test_iter_videos_job_deadline(mock_sleep, video_gen, mock_session):
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": "slow"}}},
+        {"data": {"task": {"id": "fast"}}},
+    ]
+
+    def fake_get(url):
+        response = MagicMock()
+        if url.endswith("slow"):
+            response.json.return_value = {"data": {"status": 5}}
+        else:
+            response.json.return_value = {
+                "data": {"status": 99, "works": [{"resource": {"resource": "url"}}]}
+            }
+        return response
+
+    mock_session.get.side_effect = fake_get
+    video_gen.poll_interval = 0
+    video_gen.work_ready_delay = 0
+
+    results = list(
+        video_gen.iter_videos(
+            [{"prompt": "a", "timeout": 0}, {"prompt": "b"}], max_workers=1
+        )
+    )
+    assert [r.task_id for r in results] == ["fast"]
+    assert video_gen.unfinished_tasks == ["slow"]
+    assert video_gen.progress.tasks["slow"]["phase"] == "timeout"
+
+
+def test_mirror_to_s3(video_gen, mock_session):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+
+    def fake_get(url, stream):
+        response = MagicMock(status_code=200)
+        response.raw = io.BytesIO(url.encode())
+        download = MagicMock()
+        download.__enter__.return_value = response
+        return download
+
+    mock_session.get.side_effect = fake_get
+
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="kling")
+        sink = S3Sink("kling", prefix="runs/", client=client)
+        results = video_gen.mirror(
+            [
+                WorkResult(0, "task_a", "https://cdn/a.mp4"),
+                WorkResult(0, "task_a", "https://cdn/b.mp4"),
+            ],
+            sink,
+        )
+
+        assert sorted(r.key for r in results) == [
+            "runs/task_a/0.mp4",
+            "runs/task_a/1.mp4",
+        ]
+        body = client.get_object(Bucket="kling", Key="runs/task_a/1.mp4")["Body"]
+        assert body.read() == b"https://cdn/b.mp4"
+    assert video_gen.progress.bytes_downloaded == 2 * len(b"https://cdn/a.mp4")
+
+
+def test_mirror_yields_before_next_result(video_gen):
+    sink = MagicMock()
+    sink.object_key.side_effect = lambda result, index: f"{result.task_id}/{index}"
+    sink.put.side_effect = lambda session, url, key, callback, cancel: key
+    more = threading.Event()
+
+    def results():
+        yield WorkResult(0, "task_a", "https://cdn/a.mp4")
+        # the next job is still generating
+        more.wait(5)
+        yield WorkResult(1, "task_b", "https://cdn/b.mp4")
+
+    mirrored = video_gen.mirror(results(), sink)
+    start = time.time()
+    assert next(mirrored).key == "task_a/0"
+    assert time.time() - start < 1
+    more.set()
+    assert [r.key for r in mirrored] == ["task_b/0"]
+
+
+def test_mirror_stop_cancels_input(video_gen, mock_session):
+    sink = MagicMock()
+    sink.object_key.side_effect = lambda result, index: f"{result.task_id}/{index}"
+    sink.put.side_effect = lambda session, url, key, callback, cancel: key
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    # still generating
+    mock_session.get.return_value.json.return_value = {"data": {"status": 5}}
+    cancel = CancelToken()
+    results = itertools.chain(
+        [WorkResult(0, "task_a", "https://cdn/a.mp4")],
+        video_gen.iter_videos([{"prompt": "a"}], cancel=cancel),
+    )
+
+    mirrored = video_gen.mirror(results, sink, cancel=cancel)
+    assert next(mirrored).key == "task_a/0"
+    while not mock_session.post.called:
+        time.sleep(0.01)
+    start = time.time()
+    mirrored.close()
+    assert time.time() - start < 1
+    # the input stopped polling and gave its task up
+    assert video_gen.unfinished_tasks == ["mock_id"]
+
+
+def test_cancel_stops_running_download(video_gen, mock_session, tmp_path):
+    cancel = CancelToken()
+
+    def chunks(chunk_size):
+        yield b"first"
+        # cancelled while the download is running
+        cancel.cancel()
+        yield b"second"
+
+    mock_session.get.return_value.status_code = 200
+    mock_session.get.return_value.iter_content.side_effect = chunks
+    path = tmp_path / "0.mp4"
+    with pytest.raises(TaskCancelled):
+        video_gen._download("https://cdn/a.mp4", str(path), cancel)
+    assert not path.exists()
+    assert video_gen.progress.bytes_downloaded == len(b"first")
+
+
+def test_cancel_stops_s3_upload():
+    pytest.importorskip("boto3")
+    cancel = CancelToken()
+    client = MagicMock()
+    client.upload_fileobj.side_effect = lambda reader, *args, **kwargs: reader.read(8)
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value.status_code = 200
+    sink = S3Sink("kling", client=client)
+
+    sink.put(session, "https://cdn/a.mp4", "a.mp4", cancel=cancel)
+    cancel.cancel()
+    with pytest.raises(TaskCancelled):
+        sink.put(session, "https://cdn/a.mp4", "a.mp4", cancel=cancel)
+
+
+def test_submit_and_collect_handles(video_gen, mock_session):
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": "task_a"}}},
+        {"data": {"task": {"id": "task_b"}}},
+    ]
+    status_calls = mock_session.get.call_count
+    handles = [
+        video_gen.submit_video("a"),
+        video_gen.submit_video("b", is_high_quality=True),
+    ]
+    assert [h.task_type for h in handles] == ["m2v_txt2video", "m2v_txt2video_hq"]
+    # no status request yet
+    assert mock_session.get.call_count == status_calls
+
+    handle = TaskHandle.from_json(handles[1].to_json())
+    assert handle == handles[1]
+
+    mock_session.get.return_value.json.return_value = {"data": {"status": 5}}
+    assert video_gen.poll_once(handle) == TaskStatus.PENDING
+    with pytest.raises(Exception):
+        video_gen.result(handle)
+
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+    assert video_gen.result(handles) == [["mock_url"], ["mock_url"]]
+    video_gen.work_ready_delay = 0
+    assert video_gen.wait(handles) == [["mock_url"], ["mock_url"]]
+
+
+@patch("kling.kling.time.sleep")
+def test_wait_handles_timeout(mock_sleep, video_gen, mock_session):
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": "task_a"}}},
+        {"data": {"task": {"id": "task_b"}}},
+    ]
+    handles = [video_gen.submit_video("a"), video_gen.submit_video("b")]
+    mock_session.get.return_value.json.return_value = {"data": {"status": 5}}
+
+    with pytest.raises(TaskTimeout) as exc_info:
+        video_gen.wait(handles, timeout=0)
+    assert exc_info.value.task_ids == ["task_a", "task_b"]
+
+
+def test_handle_from_other_account(video_gen):
+    handle = TaskHandle("task_a", "m2v_txt2video", "other", time.time())
+    with pytest.raises(Exception):
+        video_gen.poll_once(handle)
+
+
+@patch("kling.kling.time.sleep")
+@patch.object(ImageGen, "image_uploader", return_value="mock_image_url")
+def test_get_images_fans_out(mock_uploader, mock_sleep, image_gen, mock_session):
+    payloads = []
+
+    def fake_post(url, json):
+        payloads.append(json)
+        response = MagicMock()
+        response.json.return_value = {"data": {"task": {"id": str(len(payloads))}}}
+        return response
+
+    def fake_get(url):
+        task_id = url.split("taskId=")[-1]
+        response = MagicMock()
+        response.json.return_value = {
+            "data": {
+                "status": 99,
+                "works": [
+                    {"resource": {"resource": f"{task_id}-{i}"}} for i in range(4)
+                ],
+            }
+        }
+        return response
+
+    mock_session.post.side_effect = fake_post
+    mock_session.get.side_effect = fake_get
+    image_gen.poll_interval = 0
+    image_gen.work_ready_delay = 0
+    image_gen.scheduler = Scheduler()
+    image_gen.scheduler.acquire = MagicMock(wraps=image_gen.scheduler.acquire)
+
+    links = image_gen.get_images(
+        "mock_prompt", image_path="mock_image.jpg", count=10, max_workers=1
+    )
+    mock_uploader.assert_called_once_with("mock_image.jpg")
+    # an interactive call, even when fanned out
+    priorities = [call.args[1] for call in image_gen.scheduler.acquire.call_args_list]
+    assert priorities == [Priority.INTERACTIVE] * 3
+    counts = [
+        arg["value"]
+        for payload in payloads
+        for arg in payload["arguments"]
+        if arg["name"] == "imageCount"
+    ]
+    assert counts == ["4", "4", "2"]
+    assert all(payload["inputs"][0]["url"] == "mock_image_url" for payload in payloads)
+    assert links[:5] == ["1-0", "1-1", "1-2", "1-3", "2-0"]
+
+
+def test_get_images_rejects_bad_count(image_gen, mock_session):
+    with pytest.raises(Exception):
+        image_gen.get_images("mock_prompt", count=0)
+    mock_session.post.assert_not_called()
+
+
+@patch("kling.kling.time.sleep")
+def test_get_images_fan_out_reports_missing(mock_sleep, image_gen, mock_session):
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": "task_a"}}},
+        {"data": {"task": {"id": "task_b"}}},
+    ]
+
+    def fake_get(url):
+        response = MagicMock()
+        if url.endswith("task_b"):
+            response.json.return_value = {"data": {"status": 50}}
+        else:
+            response.json.return_value = {
+                "data": {
+                    "status": 99,
+                    "works": [{"resource": {"resource": f"a{i}"}} for i in range(4)],
+                }
+            }
+        return response
+
+    mock_session.get.side_effect = fake_get
+    image_gen.poll_interval = 0
+    image_gen.work_ready_delay = 0
+
+    with pytest.raises(Exception, match="task_b"):
+        image_gen.get_images("mock_prompt", count=8, max_workers=1)
+
+
+def _queue_tickets(scheduler, requests):
+    # acquire in order from threads, returns the tenants in the order granted
+    granted = []
+    threads = []
+    for tenant, priority in requests:
+
+        def acquire(tenant=tenant, priority=priority):
+            ticket = scheduler.acquire(tenant, priority)
+            granted.append(tenant)
+            scheduler.release(ticket)
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        threads.append(thread)
+        # make sure the ticket is queued before the next one
+        while sum(t["queued"] for t in scheduler.stats().values()) < len(threads):
+            time.sleep(0.001)
+    return granted, threads
+
+
+def test_scheduler_interactive_first():
+    scheduler = Scheduler(max_concurrent=1)
+    holder = scheduler.acquire("team-a", Priority.BATCH)
+    granted, threads = _queue_tickets(
+        scheduler,
+        [("team-a", Priority.BATCH), ("team-b", Priority.INTERACTIVE)],
+    )
+    assert scheduler.stats()["team-a"]["queued"] == 1
+    scheduler.release(holder)
+    for thread in threads:
+        thread.join()
+    assert granted == ["team-b", "team-a"]
+
+
+def test_scheduler_weighted_fair_and_quota():
+    scheduler = Scheduler(max_concurrent=1, weights={"big": 2})
+    holder = scheduler.acquire("other")
+    granted, threads = _queue_tickets(
+        scheduler, [("small", Priority.BATCH)] * 3 + [("big", Priority.BATCH)] * 4
+    )
+    scheduler.release(holder)
+    for thread in threads:
+        thread.join()
+    assert granted[:3].count("big") == 2
+    assert granted.count("big") == 4
+
+    scheduler = Scheduler(max_concurrent=4, quotas={"small": 1})
+    ticket = scheduler.acquire("small")
+    granted, threads = _queue_tickets(scheduler, [("small", Priority.BATCH)])
+    scheduler.acquire("big")
+    stats = scheduler.stats()
+    assert (stats["small"]["queued"], stats["small"]["running"]) == (1, 1)
+    assert stats["big"]["running"] == 1
+    scheduler.release(ticket)
+    threads[0].join()
+    assert granted == ["small"]
+
+
+@patch("kling.kling.time.sleep")
+def test_get_video_holds_scheduler_slot(mock_sleep, video_gen, mock_session):
+    video_gen.scheduler = Scheduler(max_concurrent=1)
+    video_gen.tenant = "team-a"
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+
+    assert video_gen.get_video("mock_prompt") == ["mock_url"]
+    assert video_gen.scheduler.stats()["team-a"]["running"] == 0
+
+
+def test_submit_more_handles_than_slots(mock_session):
+    scheduler = Scheduler(max_concurrent=2)
+    submitter, collector = VideoGen("mock_cookie"), VideoGen("mock_cookie")
+    submitter.scheduler = collector.scheduler = scheduler
+    collector.work_ready_delay = 0
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": f"task_{i}"}}} for i in range(5)
+    ]
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+
+    # submit-only calls do not keep a slot until someone collects them
+    handles = [submitter.submit_video("mock_prompt") for _ in range(5)]
+    assert scheduler.stats()["default"]["running"] == 0
+    handles = [TaskHandle.from_json(handle.to_json()) for handle in handles]
+    assert collector.wait(handles) == [["mock_url"]] * 5
+    assert scheduler.stats()["default"]["running"] == 0
+
+
+def test_scheduler_releases_held_task():
+    scheduler = Scheduler(max_concurrent=1)
+    scheduler.hold("task_a", scheduler.acquire("default"))
+    assert scheduler.stats()["default"]["running"] == 1
+    # whichever generator sees the task finish gives the slot back
+    scheduler.release_task("task_a")
+    scheduler.release_task("task_a")
+    assert scheduler.stats()["default"]["running"] == 0
+
+
+def test_cancel_while_waiting_for_slot(image_gen, mock_session):
+    image_gen.scheduler = Scheduler(max_concurrent=1)
+    # another tenant holds the only slot
+    ticket = image_gen.scheduler.acquire("other")
+    cancel = CancelToken()
+    threading.Timer(0.2, cancel.cancel).start()
+
+    start = time.time()
+    with pytest.raises(TaskCancelled):
+        list(image_gen.iter_images([{"prompt": "a"}], cancel=cancel))
+    assert time.time() - start < 1
+    image_gen.scheduler.release(ticket)
+    mock_session.post.assert_not_called()
+    assert all(t["queued"] == 0 for t in image_gen.scheduler.stats().values())
+
+
+@patch("kling.kling.time.sleep")
+def test_iter_images_more_jobs_than_slots(mock_sleep, image_gen, mock_session):
+    image_gen.scheduler = Scheduler(max_concurrent=1)
+    image_gen.poll_interval = 0
+    image_gen.work_ready_delay = 0
+    mock_session.post.return_value.json.side_effect = [
+        {"data": {"task": {"id": f"task_{i}"}}} for i in range(3)
+    ]
+    mock_session.get.return_value.json.return_value = {
+        "data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}
+    }
+
+    # slots are given back while the other jobs are still waiting to submit
+    results = list(image_gen.iter_images([{"prompt": "a"}] * 3, max_workers=3))
+    assert sorted(r.job_index for r in results) == [0, 1, 2]
+    assert image_gen.scheduler.stats()["default"]["running"] == 0
+
+
+@patch("kling.kling.time.sleep")
+def test_trace_get_video(mock_sleep, video_gen, mock_session, tmp_path):
+    mock_session.post.return_value.json.return_value = {
+        "data": {"task": {"id": "mock_id"}}
+    }
+    mock_session.get.return_value.json.side_effect = [
+        {"data": {"status": 5}},
+        {"data": {"status": 99, "works": [{"resource": {"resource": "mock_url"}}]}},
+    ]
+    trace_path = tmp_path / "trace.json"
+
+    with trace(str(trace_path)):
+        video_gen.get_video("mock_prompt")
+
+    with open(trace_path) as f:
+        events = json.load(f)["traceEvents"]
+    spans = [e for e in events if e["ph"] == "X"]
+    assert [e["name"] for e in spans] == [
+        "submit",
+        "poll",
+        "sleep",
+        "poll",
+        "sleep",
+        "wait",
+    ]
+    assert spans[0]["args"]["task_id"] == "mock_id"
+    assert spans[1]["args"]["task_id"] == "mock_id"
+    assert spans[2]["args"]["seconds"] == str(video_gen.poll_interval)
+    assert any(e["ph"] == "M" for e in events)
+
+
+def test_trace_http_request():
+    response = MagicMock(status_code=200)
+    request = BaseGen._traced_request(MagicMock(return_value=response))
+
+    with trace() as tracer:
+        request("GET", "https://klingai.com/api/task/status?taskId=42")
+    assert request("GET", "https://klingai.com/") is response
+
+    (event,) = tracer.events
+    assert event["name"] == "GET /api/task/status"
+    assert event["cat"] == "http"
+    assert event["args"]["task_id"] == "42"
+    assert event["args"]["status"] == 200
+
+
 if __name__ == "__main__":
     pytest.main()